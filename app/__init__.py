@@ -1,32 +1,178 @@
 import os
+import sqlite3
 from flask import Flask, render_template
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
+from werkzeug.middleware.proxy_fix import ProxyFix
+from sqlalchemy import event, inspect, text
 
 db = SQLAlchemy()
 login = LoginManager()
 login.login_view = 'main.login'
 
-def create_app():
+def configure_sqlite(engine, pragmas):
+    # Applied to every new pooled connection
+    @event.listens_for(engine, 'connect')
+    def set_pragmas(dbapi_connection, connection_record):
+        if not isinstance(dbapi_connection, sqlite3.Connection):
+            return
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f'PRAGMA {name}={value}')
+        cursor.close()
+
+def create_schema():
+    db.create_all()
+    # create_all() skips the new columns and indexes of tables that already
+    # exist; new columns are nullable, so SQLite can simply add them
+    inspector = inspect(db.engine)
+    with db.engine.begin() as connection:
+        for table in db.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing:
+                    connection.execute(text(f'ALTER TABLE "{table.name}" ADD COLUMN "{column.name}" '
+                                            f'{column.type.compile(db.engine.dialect)}'))
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+
+def create_app(config=None):
     app = Flask(__name__, instance_relative_config=True)
     app.config.from_mapping(
         SECRET_KEY=os.environ.get('SECRET_KEY', 'dev'),
         SQLALCHEMY_DATABASE_URI=f"sqlite:///{os.path.join(app.instance_path, 'face_attendance.sqlite3')}",
         SQLALCHEMY_TRACK_MODIFICATIONS=False,
+        # Wait for the write lock instead of failing with "database is locked"
+        SQLALCHEMY_ENGINE_OPTIONS={'connect_args': {'timeout': 30}},
+        SQLITE_PRAGMAS={
+            'journal_mode': 'WAL',
+            'synchronous': 'NORMAL',
+            'busy_timeout': 30000,
+            'cache_size': -20000,
+            'temp_store': 'MEMORY',
+        },
         UPLOAD_FOLDER=os.path.join(app.instance_path, "images"),
+        FACE_MATCH_TOLERANCE=0.6,
+        # Recognition processes and queued jobs per server process: N web
+        # workers run N pools, so by default the CPUs are split across the
+        # WEB_CONCURRENCY workers (gunicorn reads the same variable). 0 runs
+        # face detection/encoding inline on the request thread.
+        RECOGNITION_WORKERS=int(os.environ.get(
+            'RECOGNITION_WORKERS', max(1, (os.cpu_count() or 1) // int(os.environ.get('WEB_CONCURRENCY', 1))))),
+        RECOGNITION_QUEUE_SIZE=int(os.environ.get('RECOGNITION_QUEUE_SIZE', 16)),
+        RECOGNITION_TIMEOUT=10,
+        # Photos per group attendance request; never more than the
+        # recognition pool can take at once (workers + queue)
+        GROUP_MAX_PHOTOS=10,
+        RECOGNITION_RETRY_AFTER=2,
+        # Faces are detected on a copy whose longest side is at most this
+        DETECTION_MAX_SIDE=640,
+        DETECTION_MODEL='hog',
+        DETECTION_UPSAMPLE=1,
+        # Group photos show a whole class, so faces are small: detect on a
+        # much larger copy (0 keeps the full resolution)
+        GROUP_DETECTION_MAX_SIDE=2400,
+        GROUP_DETECTION_UPSAMPLE=1,
+        # Kiosk face tracking: re-encode a face only when its track is new,
+        # jumps (box IoU below KIOSK_MIN_CONFIDENCE) or is due for re-verification
+        KIOSK_SESSION_TTL=900,
+        KIOSK_TRACK_IOU=0.3,
+        KIOSK_MIN_CONFIDENCE=0.6,
+        KIOSK_REVERIFY_FRAMES=30,
+        KIOSK_RETRY_FRAMES=5,
+        KIOSK_MAX_MISSES=5,
+        # 'exact' scans every template, 'ivf' probes ANN_NPROBE k-means
+        # partitions once a search covers at least ANN_MIN_ROWS templates.
+        # Course-scoped searches only cover the enrolled students, so they
+        # scan exactly unless a single course holds ANN_MIN_ROWS templates;
+        # group assignment always scans its course exactly.
+        GALLERY_BACKEND=os.environ.get('GALLERY_BACKEND', 'exact'),
+        ANN_NLIST=None,
+        ANN_NPROBE=8,
+        ANN_MIN_ROWS=20000,
+        # Trained centroids plus the labels of the rows they were last fitted
+        # or fully assigned to. Registrations and deletions only update the
+        # labels in memory, so a process that loads a changed gallery
+        # reassigns every row with the stored centroids (no retraining) and
+        # rewrites the file.
+        ANN_INDEX_PATH=os.path.join(app.instance_path, 'face_index.npz'),
+        # Memory-mapped gallery shared by all server processes; None keeps a
+        # private copy per process (needs flock, so POSIX only by default)
+        GALLERY_PATH=os.path.join(app.instance_path, 'face_gallery.bin') if os.name == 'posix' else None,
+        LOGS_PER_PAGE=50,
+        # Attendance inserts arriving within this window share one commit;
+        # 0 commits each request on its own
+        ATTENDANCE_BATCH_WINDOW_MS=5,
+        ATTENDANCE_BATCH_MAX=200,
+        ATTENDANCE_WRITE_TIMEOUT=10,
+        # A student is logged at most once per course in each window
+        ATTENDANCE_WINDOW_MINUTES=60,
+        # Token buckets on the recognition endpoints: sustained requests per
+        # second and burst size, per signed-in user, per client IP and per
+        # account targeted by a face login (0: off). Behind a load balancer
+        # set PROXY_FIX_X_FOR, or every request shares the balancer's IP.
+        RATE_LIMIT_USER_RATE=0.5,
+        RATE_LIMIT_USER_BURST=5,
+        RATE_LIMIT_IP_RATE=float(os.environ.get('RATE_LIMIT_IP_RATE', 5.0)),
+        RATE_LIMIT_IP_BURST=20,
+        RATE_LIMIT_LOGIN_RATE=0.2,
+        RATE_LIMIT_LOGIN_BURST=5,
+        # Number of reverse proxies in front of the app whose X-Forwarded-For
+        # entries are trusted for the client address (0: use the peer address)
+        PROXY_FIX_X_FOR=int(os.environ.get('PROXY_FIX_X_FOR', 0)),
+        # Fraction of requests run under cProfile; sampled requests slower
+        # than PROFILE_SLOW_MS are written to PROFILE_DIR as .prof files
+        PROFILE_SAMPLE_RATE=float(os.environ.get('PROFILE_SAMPLE_RATE', 0)),
+        PROFILE_SLOW_MS=500,
+        PROFILE_DIR=os.path.join(app.instance_path, 'profiles'),
+        # Load the models and the gallery in a background thread at startup;
+        # /healthz/ready reports when it is done
+        WARMUP=os.environ.get('WARMUP', '1') == '1',
+        # Deployments can run `flask init-db` once instead of on every boot
+        DB_CREATE_ALL=os.environ.get('DB_CREATE_ALL', '1') == '1',
     )
+    # Overrides for benchmarks and scripts, e.g. a throwaway database
+    if config:
+        app.config.update(config)
 
     @app.errorhandler(403)
     def forbidden(e):
         return render_template('403.html'), 403     
 
+    os.makedirs(app.instance_path, exist_ok=True)
+
+    if app.config['PROXY_FIX_X_FOR']:
+        app.wsgi_app = ProxyFix(app.wsgi_app, x_for=app.config['PROXY_FIX_X_FOR'])
+
     db.init_app(app)
     login.init_app(app)
 
-    from . import routes, models
+    from .gallery import gallery
+    gallery.init_app(app)
+
+    from .recognition import recognition
+    recognition.init_app(app)
+
+    from .writebuffer import attendance_writer
+    attendance_writer.init_app(app)
+
+    from . import metrics
+    metrics.init_app(app)
+
+    from .throttle import limiter
+    limiter.init_app(app)
+
+    from . import routes, models, cli
     app.register_blueprint(routes.bp)
+    cli.init_app(app)
 
     with app.app_context():
-        db.create_all()
+        configure_sqlite(db.engine, app.config['SQLITE_PRAGMAS'])
+        if app.config['DB_CREATE_ALL']:
+            create_schema()
+
+    from .warmup import warmup
+    warmup.init_app(app)
 
     return app
\ No newline at end of file
@@ -0,0 +1,93 @@
+import os
+
+import numpy as np
+
+# Rows are assigned to centroids in chunks to bound the temporary
+# (rows x nlist) distance matrix
+_CHUNK = 8192
+
+
+def _sq_distances(rows, centroids, c_norms):
+    d = c_norms[None, :] - 2.0 * (rows @ centroids.T)
+    d += np.einsum('ij,ij->i', rows, rows)[:, None]
+    return d
+
+
+class IVFIndex:
+    """Inverted-file index: k-means coarse partitions over the gallery rows.
+
+    A query probes the nprobe closest partitions and the caller re-ranks
+    their rows exactly. The index only owns the centroids; the row ->
+    partition assignment lives next to the gallery rows it describes.
+    """
+
+    def __init__(self, centroids):
+        self.centroids = np.ascontiguousarray(centroids, dtype=np.float32)
+        self.c_norms = np.einsum('ij,ij->i', self.centroids, self.centroids)
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    @classmethod
+    def train(cls, matrix, nlist, iterations=10, sample_per_list=64, seed=0):
+        # Plain Lloyd k-means on a random sample; empty partitions are
+        # re-seeded from random sample rows.
+        rng = np.random.default_rng(seed)
+        nlist = max(1, min(nlist, len(matrix)))
+        sample_size = min(len(matrix), nlist * sample_per_list)
+        sample = np.asarray(matrix[rng.choice(len(matrix), sample_size, replace=False)], dtype=np.float32)
+        centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+        for _ in range(iterations):
+            index = cls(centroids)
+            labels = index.assign(sample)
+            counts = np.bincount(labels, minlength=nlist)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            empty = counts == 0
+            centroids = sums / np.maximum(counts, 1)[:, None]
+            centroids[empty] = sample[rng.choice(len(sample), int(empty.sum()))]
+        return cls(centroids)
+
+    def assign(self, rows):
+        rows = np.asarray(rows, dtype=np.float32)
+        labels = np.empty(len(rows), dtype=np.int32)
+        for start in range(0, len(rows), _CHUNK):
+            chunk = rows[start:start + _CHUNK]
+            labels[start:start + len(chunk)] = np.argmin(_sq_distances(chunk, self.centroids, self.c_norms), axis=1)
+        return labels
+
+    def probe(self, query, nprobe):
+        d = self.c_norms - 2.0 * (self.centroids @ query)
+        nprobe = min(nprobe, self.nlist)
+        if nprobe == self.nlist:
+            return np.arange(self.nlist)
+        return np.argpartition(d, nprobe - 1)[:nprobe]
+
+    def save(self, path, user_ids, labels):
+        # Written next to the gallery it indexes; user_ids lets a later
+        # process check the labels still line up with its rows.
+        tmp = f'{path}.{os.getpid()}.tmp'
+        with open(tmp, 'wb') as f:
+            np.savez(f, centroids=self.centroids, user_ids=user_ids, labels=labels)
+        os.replace(tmp, path)
+
+    @classmethod
+    def load(cls, path):
+        # Returns (index, user_ids, labels), or None if there is no usable file
+        try:
+            with np.load(path) as data:
+                return cls(data['centroids']), data['user_ids'], data['labels']
+        except (OSError, KeyError, ValueError):
+            return None
+
+
+class InvertedLists:
+    # CSR view of a label array: the rows of partition p are
+    # order[offsets[p]:offsets[p + 1]]
+    def __init__(self, labels, nlist):
+        self.order = np.argsort(labels, kind='stable')
+        self.offsets = np.searchsorted(labels[self.order], np.arange(nlist + 1))
+
+    def rows(self, lists):
+        return np.concatenate([self.order[self.offsets[p]:self.offsets[p + 1]] for p in lists])
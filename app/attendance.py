@@ -0,0 +1,184 @@
+from datetime import datetime, timedelta, timezone
+
+from flask import current_app
+from sqlalchemy import delete, exists, func, insert, select, update
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from . import db
+from app.models import (AttendanceLog, Course, CourseDayAttendance, Enrollment, StudentCourseAttendance, User)
+
+
+def session_key(timestamp=None):
+    # Index of the ATTENDANCE_WINDOW_MINUTES window a (naive UTC) timestamp falls in
+    timestamp = timestamp or datetime.utcnow()
+    window = current_app.config['ATTENDANCE_WINDOW_MINUTES'] * 60
+    return int(timestamp.replace(tzinfo=timezone.utc).timestamp()) // window
+
+
+def is_marked(user_id, course_id, key):
+    return db.session.execute(
+        select(AttendanceLog.id).where(AttendanceLog.user_id == user_id, AttendanceLog.course_id == course_id,
+                                       AttendanceLog.session_key == key).limit(1)
+    ).first() is not None
+
+
+def record_attendance(entries, timestamp=None):
+    # Inserts AttendanceLog rows for (user_id, course_id) pairs and updates
+    # the rollups in the same transaction; the caller commits. Each step is a
+    # single conditional statement, so concurrent writers can't double count
+    # a student's day. Pairs already logged in the current attendance window
+    # are skipped by the unique session index; returns the pairs inserted.
+    entries = list(dict.fromkeys(entries))
+    if not entries:
+        return []
+    timestamp = timestamp or datetime.utcnow()
+    day = timestamp.date()
+    key = session_key(timestamp)
+    inserted = db.session.execute(
+        sqlite_insert(AttendanceLog).on_conflict_do_nothing(index_elements=['user_id', 'course_id', 'session_key'])
+        .returning(AttendanceLog.user_id, AttendanceLog.course_id),
+        [{'user_id': user_id, 'course_id': course_id, 'timestamp': timestamp, 'session_key': key}
+         for user_id, course_id in entries],
+    ).all()
+    inserted = {tuple(row) for row in inserted}
+    entries = [entry for entry in entries if entry in inserted]
+    for user_id, course_id in entries:
+        result = db.session.execute(
+            update(StudentCourseAttendance)
+            .where(StudentCourseAttendance.user_id == user_id,
+                   StudentCourseAttendance.course_id == course_id,
+                   StudentCourseAttendance.last_day < day)
+            .values(days_present=StudentCourseAttendance.days_present + 1, last_day=day)
+        )
+        if not result.rowcount:
+            result = db.session.execute(
+                sqlite_insert(StudentCourseAttendance)
+                .values(user_id=user_id, course_id=course_id, days_present=1, last_day=day)
+                .on_conflict_do_nothing()
+            )
+        if result.rowcount:
+            # First mark of this student in this course today
+            db.session.execute(
+                sqlite_insert(CourseDayAttendance)
+                .values(course_id=course_id, day=day, present=1)
+                .on_conflict_do_update(index_elements=['course_id', 'day'],
+                                       set_={'present': CourseDayAttendance.present + 1})
+            )
+    return entries
+
+
+def forget_user(user_id):
+    # Deletes a user's attendance and takes them out of the rollups: every
+    # course-day they were present on loses one, and course-days nobody else
+    # attended disappear, as rebuild_rollups() would leave them. Courses the
+    # user teaches are deleted along with them, so their rollups go too.
+    # Returns the ids of those courses; the caller commits.
+    taught = [course_id for course_id, in db.session.execute(select(Course.id).where(Course.teacher_id == user_id))]
+    forget_courses(taught)
+    attended = exists().where(AttendanceLog.user_id == user_id,
+                              AttendanceLog.course_id == CourseDayAttendance.course_id,
+                              func.date(AttendanceLog.timestamp) == CourseDayAttendance.day)
+    db.session.execute(update(CourseDayAttendance).where(attended)
+                       .values(present=CourseDayAttendance.present - 1))
+    db.session.execute(delete(CourseDayAttendance).where(CourseDayAttendance.present <= 0))
+    db.session.execute(delete(AttendanceLog).where(AttendanceLog.user_id == user_id))
+    db.session.execute(delete(StudentCourseAttendance).where(StudentCourseAttendance.user_id == user_id))
+    return taught
+
+
+def forget_courses(course_ids):
+    # Drops the rollups of courses about to be deleted; SQLite may hand their
+    # ids to new courses, which must not inherit the old sessions and rates
+    if course_ids:
+        db.session.execute(delete(CourseDayAttendance).where(CourseDayAttendance.course_id.in_(course_ids)))
+        db.session.execute(delete(StudentCourseAttendance).where(StudentCourseAttendance.course_id.in_(course_ids)))
+
+
+def rebuild_rollups():
+    # Recomputes both rollup tables from the full AttendanceLog history
+    day = func.date(AttendanceLog.timestamp)
+    db.session.execute(delete(CourseDayAttendance))
+    db.session.execute(delete(StudentCourseAttendance))
+    db.session.execute(insert(CourseDayAttendance).from_select(
+        ['course_id', 'day', 'present'],
+        select(AttendanceLog.course_id, day, func.count(AttendanceLog.user_id.distinct()))
+        .group_by(AttendanceLog.course_id, day)
+    ))
+    db.session.execute(insert(StudentCourseAttendance).from_select(
+        ['user_id', 'course_id', 'days_present', 'last_day'],
+        select(AttendanceLog.user_id, AttendanceLog.course_id, func.count(day.distinct()), func.max(day))
+        .group_by(AttendanceLog.user_id, AttendanceLog.course_id)
+    ))
+    db.session.commit()
+    return CourseDayAttendance.query.count(), StudentCourseAttendance.query.count()
+
+
+def course_summaries(courses, today=None):
+    # Headline numbers per course from the rollups: a fixed number of
+    # grouped queries over at most one row per course and day.
+    today = today or datetime.utcnow().date()
+    course_ids = [course.id for course in courses]
+    if not course_ids:
+        return []
+    enrolled = dict(db.session.execute(
+        select(Enrollment.course_id, func.count()).where(Enrollment.course_id.in_(course_ids))
+        .group_by(Enrollment.course_id)
+    ).all())
+    held = {course_id: (sessions, total) for course_id, sessions, total in db.session.execute(
+        select(CourseDayAttendance.course_id, func.count(), func.sum(CourseDayAttendance.present))
+        .where(CourseDayAttendance.course_id.in_(course_ids))
+        .group_by(CourseDayAttendance.course_id)
+    )}
+    present_today = dict(db.session.execute(
+        select(CourseDayAttendance.course_id, CourseDayAttendance.present)
+        .where(CourseDayAttendance.course_id.in_(course_ids), CourseDayAttendance.day == today)
+    ).all())
+
+    summaries = []
+    for course in courses:
+        students = enrolled.get(course.id, 0)
+        sessions, total = held.get(course.id, (0, 0))
+        summaries.append({
+            'course': course,
+            'enrolled': students,
+            'sessions': sessions,
+            'present_today': present_today.get(course.id, 0),
+            'rate': total / (sessions * students) if sessions and students else None,
+        })
+    return summaries
+
+
+def course_trend(course_id, days=14, today=None):
+    # Present counts for the last `days` days, oldest first
+    today = today or datetime.utcnow().date()
+    rows = dict(db.session.execute(
+        select(CourseDayAttendance.day, CourseDayAttendance.present)
+        .where(CourseDayAttendance.course_id == course_id,
+               CourseDayAttendance.day > today - timedelta(days=days))
+    ).all())
+    return [(day, rows.get(day, 0)) for day in (today - timedelta(days=n) for n in range(days - 1, -1, -1))]
+
+
+def student_rates(course_id, today=None):
+    # Every enrolled student with days present, rate and whether they are
+    # absent today, lowest rate first. Bounded by the class size.
+    today = today or datetime.utcnow().date()
+    sessions = db.session.execute(
+        select(func.count()).select_from(CourseDayAttendance).where(CourseDayAttendance.course_id == course_id)
+    ).scalar()
+    rows = db.session.execute(
+        select(User.id, User.name, StudentCourseAttendance.days_present, StudentCourseAttendance.last_day)
+        .join(Enrollment, Enrollment.student_id == User.id)
+        .outerjoin(StudentCourseAttendance, (StudentCourseAttendance.user_id == User.id)
+                   & (StudentCourseAttendance.course_id == course_id))
+        .where(Enrollment.course_id == course_id)
+    ).all()
+    students = [{
+        'user_id': user_id,
+        'name': name,
+        'days_present': days_present or 0,
+        'rate': (days_present or 0) / sessions if sessions else None,
+        'absent_today': last_day != today,
+    } for user_id, name, days_present, last_day in rows]
+    students.sort(key=lambda s: (s['rate'] if s['rate'] is not None else 0.0, s['name']))
+    return sessions, students
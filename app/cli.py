@@ -0,0 +1,80 @@
+import os
+
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+
+from app.embeddings import migrate_legacy_encodings
+
+
+@click.command('init-db')
+@with_appcontext
+def init_db_command():
+    """Create any missing tables and indexes."""
+    from app import create_schema
+
+    create_schema()
+    click.echo('Database schema is up to date.')
+
+
+@click.command('migrate-embeddings')
+@with_appcontext
+def migrate_embeddings_command():
+    """Convert pickled User.face_encoding values into FaceEmbedding rows."""
+    from app.gallery import gallery
+
+    migrated = migrate_legacy_encodings()
+    if migrated:
+        gallery.invalidate()
+    click.echo(f'Migrated face encodings for {migrated} user(s).')
+
+
+@click.command('import-roster')
+@click.argument('source', type=click.Path(exists=True))
+@click.option('--report', 'report_path', type=click.Path(), default=None,
+              help='Resumable JSON-lines report (default: <source>.report.jsonl).')
+@click.option('--workers', type=int, default=None, help='Encoding processes (default: CPU count).')
+@click.option('--batch-size', type=int, default=100, show_default=True, help='Users per transaction.')
+@click.option('--default-password', default=None, help='Password for people without one in the manifest.')
+@with_appcontext
+def import_roster_command(source, report_path, workers, batch_size, default_password):
+    """Enroll people from a directory of per-person image folders or a CSV manifest."""
+    from app.roster import import_roster, read_roster
+
+    report_path = report_path or os.path.normpath(source) + '.report.jsonl'
+    counts = import_roster(read_roster(source), report_path, current_app.config, workers=workers,
+                           batch_size=batch_size, default_password=default_password, echo=click.echo)
+    click.echo(f"Done: {counts['ok']} imported, {counts['failed']} failed. Report: {report_path}")
+
+
+@click.command('rebuild-ann-index')
+@with_appcontext
+def rebuild_ann_index_command():
+    """Retrain the IVF partitions of the face gallery from the stored templates."""
+    from app.gallery import gallery
+
+    if gallery.backend != 'ivf':
+        click.echo('GALLERY_BACKEND is not "ivf"; nothing to do.')
+        return
+    gallery.invalidate()
+    gallery.snapshot()
+    gallery.rebuild_index()
+    click.echo(f'Indexed {len(gallery)} templates into {gallery.index_path}.')
+
+
+@click.command('rebuild-rollups')
+@with_appcontext
+def rebuild_rollups_command():
+    """Rebuild the attendance rollup tables from the full attendance log."""
+    from app.attendance import rebuild_rollups
+
+    days, students = rebuild_rollups()
+    click.echo(f'Rebuilt {days} course-day and {students} student-course rollup rows.')
+
+
+def init_app(app):
+    app.cli.add_command(init_db_command)
+    app.cli.add_command(migrate_embeddings_command)
+    app.cli.add_command(import_roster_command)
+    app.cli.add_command(rebuild_ann_index_command)
+    app.cli.add_command(rebuild_rollups_command)
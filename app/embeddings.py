@@ -0,0 +1,81 @@
+import pickle
+
+import numpy as np
+from sqlalchemy import func, inspect, select, text
+
+from . import db
+
+# Every template is stored as EMBEDDING_DIM little-endian float32 values;
+# a user's blob is k templates back to back (k * 512 bytes).
+EMBEDDING_DIM = 128
+EMBEDDING_DTYPE = np.dtype('<f4')
+TEMPLATE_BYTES = EMBEDDING_DIM * EMBEDDING_DTYPE.itemsize
+
+
+def pack(encodings):
+    rows = np.asarray(encodings, dtype=EMBEDDING_DTYPE).reshape(-1, EMBEDDING_DIM)
+    return rows.tobytes(), len(rows)
+
+
+def unpack(data):
+    return np.frombuffer(data, dtype=EMBEDDING_DTYPE).reshape(-1, EMBEDDING_DIM)
+
+
+def template_counts():
+    # (user_ids, templates per user) sorted by user id, without reading blobs
+    from app.models import FaceEmbedding
+
+    rows = db.session.execute(select(FaceEmbedding.user_id, FaceEmbedding.num_samples)
+                              .where(FaceEmbedding.num_samples > 0).order_by(FaceEmbedding.user_id)).all()
+    return np.array([r[0] for r in rows], dtype=np.int64), np.array([r[1] for r in rows], dtype=np.int64)
+
+
+def load_all_embeddings(user_ids=None):
+    # Streams every template into one preallocated buffer straight from the
+    # raw rows, without building ORM objects. Returns (matrix, row_user_ids).
+    from app.models import FaceEmbedding
+
+    total_query = select(func.coalesce(func.sum(FaceEmbedding.num_samples), 0))
+    rows_query = (select(FaceEmbedding.user_id, FaceEmbedding.num_samples, FaceEmbedding.data)
+                  .order_by(FaceEmbedding.user_id))
+    if user_ids is not None:
+        total_query = total_query.where(FaceEmbedding.user_id.in_(user_ids))
+        rows_query = rows_query.where(FaceEmbedding.user_id.in_(user_ids))
+
+    total = db.session.execute(total_query).scalar()
+    matrix = np.empty((total, EMBEDDING_DIM), dtype=EMBEDDING_DTYPE)
+    row_user_ids = np.empty(total, dtype=np.int64)
+    pos = 0
+    result = db.session.execute(rows_query.execution_options(yield_per=1000))
+    for user_id, num_samples, data in result:
+        if len(data) != num_samples * TEMPLATE_BYTES or pos + num_samples > total:
+            continue
+        matrix[pos:pos + num_samples] = unpack(data)
+        row_user_ids[pos:pos + num_samples] = user_id
+        pos += num_samples
+    return matrix[:pos], row_user_ids[:pos]
+
+
+def migrate_legacy_encodings():
+    # Converts the pickled User.face_encoding column used by older databases
+    # into FaceEmbedding rows. The legacy column is cleared, not dropped.
+    from app.models import FaceEmbedding
+
+    columns = {c['name'] for c in inspect(db.engine).get_columns('user')}
+    if 'face_encoding' not in columns:
+        return 0
+
+    migrated = 0
+    rows = db.session.execute(text('SELECT id, face_encoding FROM user WHERE face_encoding IS NOT NULL')).all()
+    for user_id, raw in rows:
+        encodings = pickle.loads(raw)
+        if encodings is not None and len(encodings):
+            data, num_samples = pack(encodings)
+            embedding = db.session.get(FaceEmbedding, user_id) or FaceEmbedding(user_id=user_id)
+            embedding.num_samples = num_samples
+            embedding.data = data
+            db.session.add(embedding)
+            migrated += 1
+    db.session.execute(text('UPDATE user SET face_encoding = NULL WHERE face_encoding IS NOT NULL'))
+    db.session.commit()
+    return migrated
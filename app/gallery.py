@@ -0,0 +1,387 @@
+import os
+import threading
+from collections import namedtuple
+
+import numpy as np
+
+from app import galleryfile
+from app.ann import IVFIndex, InvertedLists
+from app.embeddings import EMBEDDING_DIM, load_all_embeddings, template_counts
+from app.galleryfile import GalleryFile
+
+Match = namedtuple('Match', ['user_id', 'distance', 'margin'])
+
+
+class _Snapshot:
+    # Immutable view of the gallery: one contiguous float32 matrix with a
+    # row -> user id map and the cached squared row norms. With the IVF
+    # backend, labels holds the partition of every row.
+    def __init__(self, matrix, user_ids, sq_norms=None, labels=None):
+        self.matrix = np.ascontiguousarray(matrix, dtype=np.float32)
+        self.user_ids = np.ascontiguousarray(user_ids, dtype=np.int64)
+        if sq_norms is None:
+            sq_norms = np.einsum('ij,ij->i', self.matrix, self.matrix)
+        self.sq_norms = sq_norms
+        self.labels = labels
+        self.subsets = {}
+        self._grouping = None
+        self._lists = None
+
+    def copy(self):
+        return _Snapshot(self.matrix, self.user_ids, self.sq_norms, self.labels)
+
+    def grouping(self):
+        # Row order sorted by user plus the start of each user's block, so a
+        # per-user minimum is a single np.minimum.reduceat
+        if self._grouping is None:
+            order = np.argsort(self.user_ids, kind='stable')
+            users, starts = np.unique(self.user_ids[order], return_index=True)
+            self._grouping = (order, users, starts)
+        return self._grouping
+
+    def inverted_lists(self, nlist):
+        if self._lists is None:
+            self._lists = InvertedLists(self.labels, nlist)
+        return self._lists
+
+    def sq_distances(self, queries):
+        # (queries x rows) squared euclidean distances in one matrix product
+        queries = _as_rows(queries)
+        q_norms = np.einsum('ij,ij->i', queries, queries)
+        sq_dists = self.sq_norms[None, :] - 2.0 * (queries @ self.matrix.T) + q_norms[:, None]
+        return np.maximum(sq_dists, 0.0, out=sq_dists)
+
+    def subset(self, user_ids):
+        return _Subset(self, user_ids)
+
+    def __len__(self):
+        return len(self.user_ids)
+
+
+class _Subset:
+    # The rows of some users in a snapshot. Only the row indices (and the
+    # mask, for filtering ANN candidates) are kept; template rows are
+    # gathered per query rather than copied for every cached course.
+    def __init__(self, snap, user_ids):
+        self.snap = snap
+        self.mask = np.isin(snap.user_ids, user_ids)
+        self.rows = np.flatnonzero(self.mask)
+        self.user_ids = snap.user_ids[self.rows]
+        self._grouping = None
+
+    @property
+    def matrix(self):
+        return self.snap.matrix[self.rows]
+
+    @property
+    def sq_norms(self):
+        return self.snap.sq_norms[self.rows]
+
+    grouping = _Snapshot.grouping
+    sq_distances = _Snapshot.sq_distances
+
+    def __len__(self):
+        return len(self.rows)
+
+
+def _nearest(matrix, sq_norms, user_ids, query):
+    if not len(user_ids):
+        return None
+    sq_dists = sq_norms - 2.0 * (matrix @ query) + np.dot(query, query)
+    np.maximum(sq_dists, 0.0, out=sq_dists)
+    best = int(np.argmin(sq_dists))
+    if not np.isfinite(sq_dists[best]):
+        # Only tombstoned rows left
+        return None
+    user_id = int(user_ids[best])
+    distance = float(np.sqrt(sq_dists[best]))
+    others = sq_dists[user_ids != user_id]
+    margin = float(np.sqrt(others.min())) - distance if len(others) else float('inf')
+    return Match(user_id, distance, margin)
+
+
+def template_distance(templates, encoding):
+    # Smallest euclidean distance between encoding and a user's own templates
+    templates = _as_rows(templates)
+    if not len(templates):
+        return float('inf')
+    return float(np.sqrt(np.min(np.sum((templates - _as_rows(encoding)) ** 2, axis=1))))
+
+
+def _empty():
+    return _Snapshot(np.empty((0, EMBEDDING_DIM), dtype=np.float32), np.empty(0, dtype=np.int64))
+
+
+def _as_rows(encodings):
+    rows = np.asarray(encodings, dtype=np.float32)
+    return rows.reshape(-1, EMBEDDING_DIM)
+
+
+class FaceGallery:
+    """Process-level cache of every user's face encodings.
+
+    Writers swap in a new snapshot under a lock, readers only grab the
+    current snapshot reference, so matching never blocks on a rebuild.
+    GALLERY_BACKEND = 'ivf' answers large searches from an IVFIndex with
+    exact re-ranking of the probed partitions instead of a full scan.
+
+    With GALLERY_PATH set the rows live in a GalleryFile shared by every
+    server process: writes go to the file, and each process remaps its
+    snapshot when the file's version counters change.
+    """
+
+    def __init__(self, backend='exact', nlist=None, nprobe=8, min_rows=20000, index_path=None, path=None):
+        self.path = path
+        self.backend = backend
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.min_rows = min_rows
+        self.index_path = index_path
+        self._ivf = None
+        self._lock = threading.Lock()
+        self._snapshot = None
+        self._store = None
+        self._state = None
+        self._course_members = {}
+
+    def init_app(self, app):
+        self.backend = app.config['GALLERY_BACKEND']
+        self.nlist = app.config['ANN_NLIST']
+        self.nprobe = app.config['ANN_NPROBE']
+        self.min_rows = app.config['ANN_MIN_ROWS']
+        self.index_path = app.config['ANN_INDEX_PATH']
+        self.path = app.config['GALLERY_PATH']
+        app.extensions['gallery'] = self
+
+    def _load(self):
+        matrix, user_ids = load_all_embeddings()
+        if not len(user_ids):
+            return _empty()
+        return self._indexed(_Snapshot(matrix, user_ids))
+
+    def _indexed(self, snap):
+        # Attaches IVF labels to a freshly loaded snapshot: reuse the persisted
+        # ones if they still describe these rows, else assign with the
+        # persisted centroids, else train once the gallery is large enough.
+        if self.backend != 'ivf' or len(snap) < self.min_rows:
+            return snap
+        if self._ivf is None and self.index_path:
+            stored = IVFIndex.load(self.index_path)
+            if stored is not None:
+                self._ivf, stored_ids, labels = stored
+                if np.array_equal(stored_ids, snap.user_ids):
+                    snap.labels = labels
+                    return snap
+        if self._ivf is None:
+            nlist = self.nlist or int(4 * np.sqrt(len(snap)))
+            self._ivf = IVFIndex.train(snap.matrix, nlist)
+        snap.labels = self._ivf.assign(snap.matrix)
+        self._save_index(snap)
+        return snap
+
+    def _save_index(self, snap):
+        if self.index_path and snap.labels is not None:
+            self._ivf.save(self.index_path, snap.user_ids, snap.labels)
+
+    def _open_store(self):
+        # First use in this process: the shared file is checked against the
+        # database once and rebuilt if it is missing or out of date
+        galleryfile.ensure(self.path, template_counts(), load_all_embeddings)
+        return GalleryFile.open(self.path)
+
+    def _sync(self):
+        # Caller holds self._lock. Remaps a replaced file and rebuilds the
+        # local snapshot (and its course caches) after the file changed.
+        prev = self._snapshot
+        if self._store is None or self._store.superseded:
+            store = self._store and GalleryFile.open(self.path)
+            self._store = store or self._open_store()
+            self._ivf, self._state, prev = None, None, None
+        state = self._store.state()
+        if self._state is None or state[1] != self._state[1]:
+            self._course_members.clear()
+        if self._state is not None and state[2] != self._state[2]:
+            # Partitions were retrained by another process
+            self._ivf, prev = None, None
+
+        matrix, user_ids, sq_norms = self._store.rows()
+        labels = None
+        if prev is not None and prev.labels is not None and len(prev) <= len(user_ids):
+            # Same file, so rows only got appended or tombstoned
+            labels = np.concatenate([prev.labels, self._ivf.assign(matrix[len(prev):])])
+        snap = _Snapshot(matrix, user_ids, sq_norms, labels)
+        self._snapshot = snap if labels is not None else self._indexed(snap)
+        self._state = state
+
+    def replace(self, matrix, user_ids):
+        # Installs a gallery built elsewhere (benchmarks, bulk rebuilds)
+        if self.path:
+            with self._lock:
+                galleryfile.publish(self.path, matrix, user_ids)
+                # New file: nothing of the old snapshot or its partitions carries over
+                self._store, self._state, self._ivf = GalleryFile.open(self.path), None, None
+                self._snapshot = None
+            return
+        with self._lock:
+            self._course_members.clear()
+            self._snapshot = self._indexed(_Snapshot(matrix, user_ids))
+
+    def rebuild_index(self):
+        # Retrains the IVF partitions from the current rows
+        with self._lock:
+            self._ivf = None
+            if self.index_path and os.path.exists(self.index_path):
+                os.remove(self.index_path)
+            if self._snapshot is not None:
+                self._snapshot = self._indexed(self._snapshot.copy())
+            if self._store is not None:
+                galleryfile.bump(self.path, 'index')
+                self._state = self._store.state()
+
+    def snapshot(self):
+        if self.path:
+            # One header read per call; remap only when another write happened
+            if self._store is None or self._store.state() != self._state:
+                with self._lock:
+                    if self._store is None or self._store.state() != self._state:
+                        self._sync()
+            return self._snapshot
+        snap = self._snapshot
+        if snap is None:
+            with self._lock:
+                if self._snapshot is None:
+                    self._snapshot = self._load()
+                snap = self._snapshot
+        return snap
+
+    def __len__(self):
+        return len(self.snapshot())
+
+    @property
+    def size(self):
+        # Without loading the gallery if nothing has needed it yet
+        if self._store is not None:
+            return self._store.live
+        snap = self._snapshot
+        return 0 if snap is None else len(snap)
+
+    def invalidate(self):
+        if self.path:
+            # Rebuild the shared file; every process remaps on its next request
+            with self._lock:
+                galleryfile.publish(self.path, *load_all_embeddings())
+            return
+        with self._lock:
+            self._snapshot = None
+            self._course_members.clear()
+
+    def invalidate_course(self, course_id):
+        # Enrollments changed: drop the cached candidate set of this course.
+        # Cached subsets hang off the snapshot, so swap in a fresh one.
+        if self.path:
+            galleryfile.bump(self.path, 'members')
+        with self._lock:
+            self._course_members.pop(course_id, None)
+            snap = self._snapshot
+            if snap is not None:
+                self._snapshot = snap.copy()
+
+    def _members(self, course_id):
+        from app.models import Enrollment
+
+        members = self._course_members.get(course_id)
+        if members is None:
+            rows = Enrollment.query.with_entities(Enrollment.student_id).filter_by(course_id=course_id)
+            members = np.fromiter((student_id for student_id, in rows), dtype=np.int64)
+            self._course_members[course_id] = members
+        return members
+
+    def course_snapshot(self, course_id):
+        # Rows of the students enrolled in a course, cached per snapshot so
+        # gallery updates and enrollment changes both invalidate it.
+        snap = self.snapshot()
+        subset = snap.subsets.get(course_id)
+        if subset is None:
+            subset = snap.subset(self._members(course_id))
+            snap.subsets[course_id] = subset
+        return subset
+
+    def update_user(self, user_id, encodings):
+        # Replace (or add) the rows of a single user without re-reading the DB.
+        if self.path:
+            galleryfile.write_user(self.path, user_id, encodings)
+            return
+        with self._lock:
+            snap = self._snapshot
+            if snap is None:
+                return
+            keep = snap.user_ids != user_id
+            if encodings is not None and np.array_equal(snap.matrix[~keep], _as_rows(encodings)):
+                return
+            matrix, user_ids = snap.matrix[keep], snap.user_ids[keep]
+            labels = None if snap.labels is None else snap.labels[keep]
+            if encodings is not None and len(encodings):
+                block = _as_rows(encodings)
+                matrix = np.concatenate([matrix, block])
+                user_ids = np.concatenate([user_ids, np.full(len(block), user_id, dtype=np.int64)])
+                if labels is not None:
+                    labels = np.concatenate([labels, self._ivf.assign(block)])
+            new = _Snapshot(matrix, user_ids, labels=labels)
+            if labels is None:
+                new = self._indexed(new)
+            # else only the new rows were assigned to partitions, in memory;
+            # the index file is left alone (see ANN_INDEX_PATH)
+            self._snapshot = new
+
+    def remove_user(self, user_id):
+        self.update_user(user_id, None)
+
+    def match(self, encoding, course_id=None):
+        # Nearest user by euclidean distance over all stored templates (or
+        # only those of the course's enrolled students), with the margin to
+        # the closest template of any other user.
+        # Large searches on an indexed gallery only re-rank the probed IVF
+        # partitions; the margin is then relative to those candidates. The
+        # size that counts is that of the search, so a course below
+        # min_rows is scanned exactly: that is cheaper than probing, and
+        # probed partitions may hold none of its students.
+        query = np.asarray(encoding, dtype=np.float32).reshape(EMBEDDING_DIM)
+        snap = self.snapshot()
+        target = snap if course_id is None else self.course_snapshot(course_id)
+        if snap.labels is None or len(target) < self.min_rows:
+            return _nearest(target.matrix, target.sq_norms, target.user_ids, query)
+        rows = snap.inverted_lists(self._ivf.nlist).rows(self._ivf.probe(query, self.nprobe))
+        if target is not snap:
+            rows = rows[target.mask[rows]]
+        return _nearest(snap.matrix[rows], snap.sq_norms[rows], snap.user_ids[rows], query)
+
+    def assign(self, encodings, tolerance, course_id=None):
+        # Matches a whole set of faces at once and resolves one-to-one
+        # assignments: pairs are taken greedily by ascending distance, so two
+        # faces can never claim the same user. Returns {face index: Match}.
+        snap = self.snapshot() if course_id is None else self.course_snapshot(course_id)
+        if not len(snap) or not len(encodings):
+            return {}
+        order, users, starts = snap.grouping()
+        sq_dists = snap.sq_distances(encodings)[:, order]
+        per_user = np.sqrt(np.minimum.reduceat(sq_dists, starts, axis=1))
+
+        if per_user.shape[1] > 1:
+            two_best = np.partition(per_user, 1, axis=1)[:, :2]
+        else:
+            two_best = np.column_stack([per_user[:, 0], np.full(len(per_user), np.inf)])
+
+        faces, cols = np.nonzero(per_user <= tolerance)
+        candidates = np.argsort(per_user[faces, cols], kind='stable')
+        assigned, taken = {}, set()
+        for i in candidates:
+            face, col = int(faces[i]), int(cols[i])
+            if face in assigned or col in taken:
+                continue
+            distance = float(per_user[face, col])
+            assigned[face] = Match(int(users[col]), distance, float(two_best[face, 1]) - distance)
+            taken.add(col)
+        return assigned
+
+
+gallery = FaceGallery()
@@ -0,0 +1,201 @@
+import os
+from contextlib import contextmanager
+
+import numpy as np
+
+from app.embeddings import EMBEDDING_DIM
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover - Windows has no flock; one process only
+    fcntl = None
+
+MAGIC = b'FACEGAL1'
+HEADER = np.dtype([
+    ('magic', 'S8'),
+    ('version', '<u8'),     # bumped after every change to the rows
+    ('members', '<u8'),     # bumped when course enrollments change
+    ('index', '<u8'),       # bumped when the IVF partitions are retrained
+    ('count', '<u8'),       # rows written, live or tombstoned
+    ('capacity', '<u8'),
+    ('live', '<u8'),
+    ('superseded', '<u8'),  # set once a compacted file has replaced this one
+])
+MIN_CAPACITY = 1024
+
+
+class GalleryFile:
+    """Memory-mapped face gallery shared by every server process.
+
+    Layout: a HEADER record, then capacity user ids (int64), squared row
+    norms (float32) and rows (float32 x EMBEDDING_DIM). Rows are only ever
+    appended; a deleted row is tombstoned in place by setting its user id to
+    -1 and its norm to +inf, so it can never be the nearest match. Readers
+    map the file read-only and use its arrays without copying.
+    """
+
+    def __init__(self, path, mode='r'):
+        self.path = path
+        self.raw = np.memmap(path, dtype=np.uint8, mode=mode)
+        self.header = self.raw[:HEADER.itemsize].view(HEADER)
+        capacity = int(self.header['capacity'][0])
+        offset = HEADER.itemsize
+        self.user_ids = self.raw[offset:offset + 8 * capacity].view('<i8')
+        offset += 8 * capacity
+        self.sq_norms = self.raw[offset:offset + 4 * capacity].view('<f4')
+        offset += 4 * capacity
+        self.matrix = self.raw[offset:offset + 4 * capacity * EMBEDDING_DIM].view('<f4').reshape(capacity, EMBEDDING_DIM)
+
+    @classmethod
+    def open(cls, path, mode='r'):
+        # None if there is no complete gallery file at path
+        try:
+            f = cls(path, mode)
+        except (OSError, ValueError):
+            return None
+        if f.header['magic'][0] != MAGIC or f.raw.size != _file_size(int(f.header['capacity'][0])):
+            return None
+        return f
+
+    def _get(self, field):
+        return int(self.header[field][0])
+
+    @property
+    def version(self):
+        return self._get('version')
+
+    @property
+    def count(self):
+        return self._get('count')
+
+    @property
+    def live(self):
+        return self._get('live')
+
+    @property
+    def superseded(self):
+        return bool(self._get('superseded'))
+
+    def state(self):
+        # Cheap enough to check on every request
+        return self._get('version'), self._get('members'), self._get('index')
+
+    def rows(self):
+        # (matrix, user_ids, sq_norms) views of the rows written so far
+        count = self.count
+        return self.matrix[:count], self.user_ids[:count], self.sq_norms[:count]
+
+    def _bump(self, field):
+        self.header[field] += 1
+
+
+def _file_size(capacity):
+    return HEADER.itemsize + capacity * (8 + 4 + 4 * EMBEDDING_DIM)
+
+
+@contextmanager
+def locked(path):
+    # One writer at a time across processes; readers never take the lock
+    with open(f'{path}.lock', 'a') as lock:
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def _create(path, matrix, user_ids, old=None):
+    # Writes a compacted file next to path and renames it into place, then
+    # marks the old file superseded so its readers remap. Caller holds the lock.
+    matrix = np.asarray(matrix, dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+    user_ids = np.asarray(user_ids, dtype=np.int64)
+    capacity = max(MIN_CAPACITY, 2 * len(user_ids))
+    header = np.zeros(1, dtype=HEADER)
+    header['capacity'] = capacity
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'wb') as f:
+        f.write(header.tobytes())
+        f.truncate(_file_size(capacity))
+    new = GalleryFile(tmp, 'r+')
+    count = len(user_ids)
+    new.matrix[:count] = matrix
+    new.user_ids[:count] = user_ids
+    new.sq_norms[:count] = np.einsum('ij,ij->i', matrix, matrix)
+    header = new.header
+    header['count'] = header['live'] = count
+    header['version'] = 1
+    if old is not None:
+        header['version'] = old.version + 1
+        header['members'] = old._get('members') + 1
+        header['index'] = old._get('index')
+    header['magic'] = MAGIC
+    new.raw.flush()
+    os.replace(tmp, path)
+    if old is not None:
+        old.header['superseded'] = 1
+        old._bump('version')
+
+
+def publish(path, matrix, user_ids):
+    # Replaces the whole gallery, e.g. after a rebuild from the database
+    with locked(path):
+        _create(path, matrix, user_ids, GalleryFile.open(path, 'r+'))
+
+
+def ensure(path, expected, load):
+    # Makes sure a gallery file exists and holds the expected (user_ids,
+    # templates per user), rebuilding it from load() -> (matrix, user_ids)
+    # otherwise
+    with locked(path):
+        f = GalleryFile.open(path, 'r+')
+        if f is not None:
+            _, user_ids, _ = f.rows()
+            users, counts = np.unique(user_ids[user_ids >= 0], return_counts=True)
+            if np.array_equal(users, expected[0]) and np.array_equal(counts, expected[1]):
+                return
+        _create(path, *load(), old=f)
+
+
+def write_user(path, user_id, rows):
+    # Tombstones the user's current rows and appends rows (None removes the
+    # user). Returns False if the file does not exist or nothing changed.
+    with locked(path):
+        f = GalleryFile.open(path, 'r+')
+        if f is None:
+            return False
+        matrix, user_ids, _ = f.rows()
+        old = np.flatnonzero(user_ids == user_id)
+        rows = np.empty((0, EMBEDDING_DIM), dtype=np.float32) if rows is None else \
+            np.asarray(rows, dtype=np.float32).reshape(-1, EMBEDDING_DIM)
+        if np.array_equal(matrix[old], rows):
+            return False
+
+        f.user_ids[old] = -1
+        f.sq_norms[old] = np.inf
+        live = f.live - len(old)
+        count, n = f.count, len(rows)
+        if count + n > len(f.user_ids) or count - live > max(live, MIN_CAPACITY):
+            # Out of room or mostly tombstones: rewrite with only the live rows
+            keep = f.user_ids[:count] >= 0
+            _create(path, np.concatenate([matrix[keep], rows]),
+                    np.concatenate([user_ids[keep], np.full(n, user_id, dtype=np.int64)]), old=f)
+            return True
+
+        f.matrix[count:count + n] = rows
+        f.sq_norms[count:count + n] = np.einsum('ij,ij->i', rows, rows)
+        f.user_ids[count:count + n] = user_id
+        # Rows first, then the count, then the version readers poll. Pages
+        # are shared, not synced: the database stays the source of truth.
+        f.header['count'] = count + n
+        f.header['live'] = live + n
+        f._bump('version')
+        return True
+
+
+def bump(path, field):
+    with locked(path):
+        f = GalleryFile.open(path, 'r+')
+        if f is not None:
+            f._bump(field)
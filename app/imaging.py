@@ -0,0 +1,59 @@
+import time
+from contextlib import contextmanager
+
+import cv2
+import numpy as np
+
+from app.recognition import InvalidImage
+
+
+class StageTimer:
+    # Collects wall-clock milliseconds per pipeline stage
+    def __init__(self):
+        self.timings = {}
+
+    @contextmanager
+    def stage(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.timings[name] = self.timings.get(name, 0.0) + (time.perf_counter() - start) * 1000.0
+
+
+def decode_image(data):
+    # Decodes JPEG/PNG straight from the upload buffer into an RGB array.
+    # IMREAD_COLOR also applies the EXIF orientation tag of JPEGs.
+    buf = np.frombuffer(data, dtype=np.uint8)
+    image = cv2.imdecode(buf, cv2.IMREAD_COLOR) if len(buf) else None
+    if image is None:
+        raise InvalidImage('Could not read the uploaded image.')
+    return cv2.cvtColor(image, cv2.COLOR_BGR2RGB)
+
+
+def downscale(image, max_side):
+    # Shrinks the image so its longest side is at most max_side; returns the
+    # image used for detection and the factor applied to it.
+    height, width = image.shape[:2]
+    if not max_side or max(height, width) <= max_side:
+        return image, 1.0
+    scale = max_side / max(height, width)
+    size = (max(1, round(width * scale)), max(1, round(height * scale)))
+    return cv2.resize(image, size, interpolation=cv2.INTER_AREA), scale
+
+
+def scale_boxes(boxes, scale, shape):
+    # Maps (top, right, bottom, left) boxes found on the downscaled image back
+    # to full-resolution coordinates, clipped to the image.
+    if scale == 1.0:
+        return list(boxes)
+    height, width = shape[:2]
+    mapped = []
+    for top, right, bottom, left in boxes:
+        mapped.append((
+            max(0, int(round(top / scale))),
+            min(width, int(round(right / scale))),
+            min(height, int(round(bottom / scale))),
+            max(0, int(round(left / scale))),
+        ))
+    return mapped
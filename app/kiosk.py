@@ -0,0 +1,144 @@
+import itertools
+import secrets
+import threading
+import time
+
+from app.recognition import box_iou
+
+
+class Track:
+    # One face followed across frames by box overlap
+    def __init__(self, track_id, box):
+        self.track_id = track_id
+        self.box = box
+        self.user_id = None
+        self.name = None
+        self.distance = None
+        self.confidence = 0.0
+        self.since_verified = 0
+        self.misses = 0
+
+    def to_dict(self):
+        return {
+            'track_id': self.track_id,
+            'box': list(self.box),
+            'user_id': self.user_id,
+            'name': self.name,
+            'distance': None if self.distance is None else round(self.distance, 4),
+            'status': 'recognized' if self.user_id is not None else 'unknown',
+        }
+
+
+class KioskSession:
+    def __init__(self, token, course_id, owner_id, config):
+        self.token = token
+        self.course_id = course_id
+        self.owner_id = owner_id
+        self.tracks = []
+        self.logged = set()
+        self.frames = 0
+        self.last_seen = time.monotonic()
+        self.lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self.track_iou = config['KIOSK_TRACK_IOU']
+        self.min_confidence = config['KIOSK_MIN_CONFIDENCE']
+        self.reverify_frames = config['KIOSK_REVERIFY_FRAMES']
+        self.retry_frames = config['KIOSK_RETRY_FRAMES']
+        self.max_misses = config['KIOSK_MAX_MISSES']
+
+    def skip_boxes(self):
+        # Boxes of tracks that don't need a fresh encoding this frame: known
+        # faces that were verified recently and are moving smoothly, and
+        # unknown faces until their retry interval is up.
+        boxes = []
+        for track in self.tracks:
+            if track.misses:
+                continue
+            if track.user_id is not None:
+                if track.confidence >= self.min_confidence and track.since_verified < self.reverify_frames:
+                    boxes.append(track.box)
+            elif track.since_verified < self.retry_frames:
+                boxes.append(track.box)
+        return boxes
+
+    def update(self, locations, encodings):
+        # Associates the frame's detections with existing tracks by IoU.
+        # Returns [(track, encoding)] for every detection that was encoded.
+        self.frames += 1
+        self.last_seen = time.monotonic()
+        pairs = sorted(
+            ((box_iou(track.box, box), t, d) for t, track in enumerate(self.tracks) for d, box in enumerate(locations)),
+            reverse=True,
+        )
+        track_for = {}
+        used = set()
+        for iou, t, d in pairs:
+            if iou < self.track_iou:
+                break
+            if t in used or d in track_for:
+                continue
+            track_for[d] = self.tracks[t]
+            used.add(t)
+
+        for t, track in enumerate(self.tracks):
+            if t not in used:
+                track.misses += 1
+        self.tracks = [track for track in self.tracks if track.misses <= self.max_misses]
+
+        to_match = []
+        for d, box in enumerate(locations):
+            track = track_for.get(d)
+            if track is None:
+                track = Track(next(self._ids), box)
+                self.tracks.append(track)
+            else:
+                track.confidence = box_iou(track.box, box)
+                track.box = box
+                track.misses = 0
+            encoding = encodings[d] if d < len(encodings) else None
+            if encoding is None:
+                track.since_verified += 1
+            else:
+                track.since_verified = 0
+                track.confidence = 1.0
+                to_match.append((track, encoding))
+        return to_match
+
+    def to_dict(self):
+        return [track.to_dict() for track in self.tracks if not track.misses]
+
+
+class KioskRegistry:
+    """In-process kiosk sessions keyed by token.
+
+    Sessions live in the memory of one server process, so a multi-process
+    deployment needs sticky routing on the token.
+    """
+
+    def __init__(self):
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def _expire(self, ttl):
+        now = time.monotonic()
+        for token in [t for t, s in self._sessions.items() if now - s.last_seen > ttl]:
+            del self._sessions[token]
+
+    def create(self, course_id, owner_id, config):
+        session = KioskSession(secrets.token_urlsafe(16), course_id, owner_id, config)
+        with self._lock:
+            self._expire(config['KIOSK_SESSION_TTL'])
+            self._sessions[session.token] = session
+        return session
+
+    def get(self, token, config):
+        with self._lock:
+            self._expire(config['KIOSK_SESSION_TTL'])
+            return self._sessions.get(token)
+
+    def close(self, token):
+        with self._lock:
+            return self._sessions.pop(token, None)
+
+
+kiosks = KioskRegistry()
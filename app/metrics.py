@@ -0,0 +1,222 @@
+import cProfile
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+from flask import g, request
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DISTANCE_BUCKETS = (0.1, 0.2, 0.3, 0.35, 0.4, 0.45, 0.5, 0.55, 0.6, 0.7, 0.8, 1.0)
+FACE_BUCKETS = (0, 1, 2, 5, 10, 20, 50)
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, v in pairs)
+    return '{' + ','.join(f'{k}="{v}"' for (k, _), v in zip(pairs, escaped)) + '}'
+
+
+def _format_value(value):
+    return '+Inf' if value == float('inf') else repr(float(value))
+
+
+class Counter:
+    kind = 'counter'
+
+    def __init__(self, name, help, labelnames=()):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, *labels, amount=1):
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + amount
+
+    def samples(self):
+        with self._lock:
+            items = list(self._values.items())
+        for labels, value in items:
+            yield self.name, _format_labels(self.labelnames, labels), value
+
+
+class Gauge:
+    # Either set() directly or read from a callback at scrape time
+    kind = 'gauge'
+
+    def __init__(self, name, help, fn=None):
+        self.name, self.help, self.fn = name, help, fn
+        self._value = 0.0
+
+    def set(self, value):
+        self._value = value
+
+    def samples(self):
+        yield self.name, '', self.fn() if self.fn else self._value
+
+
+class Histogram:
+    kind = 'histogram'
+
+    def __init__(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        self.name, self.help, self.labelnames = name, help, tuple(labelnames)
+        self.buckets = tuple(buckets) + (float('inf'),)
+        self._series = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value, *labels):
+        with self._lock:
+            series = self._series.get(labels)
+            if series is None:
+                series = self._series[labels] = [[0] * len(self.buckets), 0.0, 0]
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+                    break
+            series[1] += value
+            series[2] += 1
+
+    def samples(self):
+        with self._lock:
+            items = [(labels, list(counts), total, count) for labels, (counts, total, count) in self._series.items()]
+        for labels, counts, total, count in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets, counts):
+                cumulative += n
+                le = (('le', _format_value(bound)),)
+                yield f'{self.name}_bucket', _format_labels(self.labelnames, labels, le), cumulative
+            yield f'{self.name}_sum', _format_labels(self.labelnames, labels), total
+            yield f'{self.name}_count', _format_labels(self.labelnames, labels), count
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def render(self):
+        # Prometheus text exposition format 0.0.4
+        lines = []
+        for metric in self.metrics:
+            lines.append(f'# HELP {metric.name} {metric.help}')
+            lines.append(f'# TYPE {metric.name} {metric.kind}')
+            for name, labels, value in metric.samples():
+                lines.append(f'{name}{labels} {_format_value(value)}')
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+request_seconds = registry.register(Histogram(
+    'http_request_duration_seconds', 'Request latency by endpoint.', ['endpoint']))
+stage_seconds = registry.register(Histogram(
+    'recognition_stage_duration_seconds', 'Latency of each recognition stage.', ['endpoint', 'stage']))
+faces_per_image = registry.register(Histogram(
+    'recognition_faces_per_image', 'Faces detected per uploaded image.', ['endpoint'], FACE_BUCKETS))
+match_distance = registry.register(Histogram(
+    'recognition_match_distance', 'Distance of the best gallery match.', ['endpoint'], DISTANCE_BUCKETS))
+outcomes = registry.register(Counter(
+    'recognition_outcomes_total', 'Recognition results by outcome.', ['endpoint', 'outcome']))
+commit_seconds = registry.register(Histogram(
+    'db_commit_duration_seconds', 'Latency of database commits.', ['source']))
+last_commit_seconds = registry.register(Gauge(
+    'db_last_commit_duration_seconds', 'Latency of the most recent database commit.'))
+
+
+def _gallery_size():
+    from app.gallery import gallery
+    return gallery.size
+
+
+def _recognition_pending():
+    from app.recognition import recognition
+    return recognition.pending
+
+
+def _writes_pending():
+    from app.writebuffer import attendance_writer
+    return attendance_writer.pending
+
+
+registry.register(Gauge('gallery_templates', 'Face templates in the loaded gallery.', _gallery_size))
+registry.register(Gauge('recognition_queue_depth', 'Recognition jobs running or queued.', _recognition_pending))
+registry.register(Gauge('attendance_write_queue_depth', 'Attendance writes waiting for a group commit.',
+                        _writes_pending))
+
+
+def observe_images(results):
+    # Worker-side stage timings (decode, resize, detect, encode) and face counts
+    endpoint = request.endpoint
+    for result in results:
+        faces_per_image.observe(len(result.locations), endpoint)
+        for stage, ms in result.timings.items():
+            stage_seconds.observe(ms / 1000.0, endpoint, stage)
+
+
+def observe_outcome(outcome, match=None):
+    outcomes.inc(request.endpoint, outcome)
+    if match is not None:
+        match_distance.observe(match.distance, request.endpoint)
+
+
+@contextmanager
+def stage(name):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        stage_seconds.observe(time.perf_counter() - start, request.endpoint, name)
+
+
+@contextmanager
+def commit_timer(source):
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        commit_seconds.observe(elapsed, source)
+        last_commit_seconds.set(elapsed)
+
+
+def init_app(app):
+    # Requests sampled at PROFILE_SAMPLE_RATE run under cProfile; those
+    # slower than PROFILE_SLOW_MS are dumped to PROFILE_DIR
+    sample_rate = app.config['PROFILE_SAMPLE_RATE']
+    slow_seconds = app.config['PROFILE_SLOW_MS'] / 1000.0
+    profile_dir = app.config['PROFILE_DIR']
+
+    @app.before_request
+    def start_timer():
+        g.request_start = time.perf_counter()
+        if sample_rate and random.random() < sample_rate:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Another profiler is already active on this thread
+                return
+            g.profiler = profiler
+
+    @app.teardown_request
+    def stop_timer(exc):
+        start = g.pop('request_start', None)
+        profiler = g.pop('profiler', None)
+        if start is None:
+            return
+        elapsed = time.perf_counter() - start
+        endpoint = request.endpoint or 'unknown'
+        request_seconds.observe(elapsed, endpoint)
+        if profiler is not None:
+            profiler.disable()
+            if elapsed >= slow_seconds:
+                # Sampled and slow: keep the profile for `python -m pstats`
+                os.makedirs(profile_dir, exist_ok=True)
+                name = f'{time.strftime("%Y%m%d-%H%M%S")}-{endpoint}-{int(elapsed * 1000)}ms-{os.getpid()}.prof'
+                profiler.dump_stats(os.path.join(profile_dir, name))
@@ -2,15 +2,22 @@ from . import db
 from datetime import datetime
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
-from sqlalchemy.types import PickleType
+from app.embeddings import pack, unpack
 
 class User(UserMixin, db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(120), nullable=False)
-    face_encoding = db.Column(PickleType, nullable=True)  # Nullable for admin/teacher if needed   
     password_hash = db.Column(db.String(128), nullable=False)
     role = db.Column(db.String(32), nullable=False, default='student')  # student, teacher, admin
 
+    # Face templates live in their own table; missing for admin/teacher if needed
+    face_embedding = db.relationship(
+        'FaceEmbedding',
+        backref='user',
+        uselist=False,
+        cascade='all, delete-orphan'
+    )
+
     # For teachers: relationship to courses they teach
     taught_courses = db.relationship(
         'Course',
@@ -42,9 +49,37 @@ class User(UserMixin, db.Model):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
+    @property
+    def face_encodings(self):
+        if self.face_embedding is None:
+            return None
+        return self.face_embedding.encodings
+
+    def set_face_encodings(self, encodings):
+        if self.face_embedding is None:
+            self.face_embedding = FaceEmbedding()
+        self.face_embedding.encodings = encodings
+
     def __repr__(self):
         return f'<User {self.name} ({self.role})>'
 
+class FaceEmbedding(db.Model):
+    # k templates of 128 little-endian float32 values, stored back to back
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    num_samples = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+
+    @property
+    def encodings(self):
+        return unpack(self.data)
+
+    @encodings.setter
+    def encodings(self, encodings):
+        self.data, self.num_samples = pack(encodings)
+
+    def __repr__(self):
+        return f'<FaceEmbedding user={self.user_id} samples={self.num_samples}>'
+
 class Semester(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     name = db.Column(db.String(50), unique=True, nullable=False)
@@ -96,6 +131,36 @@ class AttendanceLog(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
     course_id = db.Column(db.Integer, db.ForeignKey('course.id'), nullable=False)
     timestamp = db.Column(db.DateTime, default=datetime.utcnow)
+    # Attendance window the mark falls in (see attendance.session_key); a
+    # student is logged at most once per course and window. NULL for rows
+    # written before windows existed.
+    session_key = db.Column(db.Integer)
+
+    __table_args__ = (
+        db.Index('ix_attendance_log_timestamp_id', 'timestamp', 'id'),
+        db.Index('ix_attendance_log_course_timestamp', 'course_id', 'timestamp'),
+        db.Index('ix_attendance_log_user_timestamp', 'user_id', 'timestamp'),
+        db.Index('ux_attendance_log_session', 'user_id', 'course_id', 'session_key', unique=True),
+    )
+
+    def __repr__(self):
+        return f'<AttendanceLog user={self.user_id} course={self.course_id} at {self.timestamp}>'
+
+class CourseDayAttendance(db.Model):
+    # Rollup: distinct students present per course and day
+    course_id = db.Column(db.Integer, db.ForeignKey('course.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    present = db.Column(db.Integer, nullable=False, default=0)
+
+    def __repr__(self):
+        return f'<CourseDayAttendance course={self.course_id} {self.day}: {self.present}>'
+
+class StudentCourseAttendance(db.Model):
+    # Rollup: days a student was present in a course
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), primary_key=True)
+    course_id = db.Column(db.Integer, db.ForeignKey('course.id'), primary_key=True)
+    days_present = db.Column(db.Integer, nullable=False, default=0)
+    last_day = db.Column(db.Date, nullable=False)
 
     def __repr__(self):
-        return f'<AttendanceLog user={self.user_id} course={self.course_id} at {self.timestamp}>'
\ No newline at end of file
+        return f'<StudentCourseAttendance user={self.user_id} course={self.course_id}: {self.days_present}>'
@@ -0,0 +1,54 @@
+import base64
+from datetime import datetime, timedelta
+
+from sqlalchemy import tuple_
+
+from app.models import AttendanceLog
+
+
+def encode_cursor(log):
+    raw = f'{log.timestamp.isoformat()}|{log.id}'
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+
+def decode_cursor(cursor):
+    try:
+        timestamp, log_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return datetime.fromisoformat(timestamp), int(log_id)
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+
+def parse_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d') if value else None
+    except ValueError:
+        return None
+
+
+def filter_logs(query, course_id=None, user_ids=None, start=None, end=None):
+    # start and end are dates; end is inclusive
+    if course_id:
+        query = query.filter(AttendanceLog.course_id == course_id)
+    if user_ids is not None:
+        query = query.filter(AttendanceLog.user_id.in_(user_ids))
+    if start:
+        query = query.filter(AttendanceLog.timestamp >= start)
+    if end:
+        query = query.filter(AttendanceLog.timestamp < end + timedelta(days=1))
+    return query
+
+
+def keyset_page(query, cursor=None, per_page=50):
+    # Newest first on (timestamp, id). The (timestamp, id) index serves the
+    # unfiltered and date-filtered pages, and the (course_id, timestamp) and
+    # (user_id, timestamp) indexes a single course or user, all without a
+    # sort; SQLite index entries end with the rowid, i.e. id. Filtering on a
+    # set of users only sorts those users' rows. Returns (logs, next_cursor).
+    query = query.order_by(AttendanceLog.timestamp.desc(), AttendanceLog.id.desc())
+    position = decode_cursor(cursor) if cursor else None
+    if position:
+        query = query.filter(tuple_(AttendanceLog.timestamp, AttendanceLog.id) < position)
+    logs = query.limit(per_page + 1).all()
+    next_cursor = encode_cursor(logs[per_page - 1]) if len(logs) > per_page else None
+    return logs[:per_page], next_cursor
@@ -0,0 +1,227 @@
+import atexit
+import multiprocessing
+import os
+import threading
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+
+FaceResult = namedtuple('FaceResult', ['locations', 'encodings', 'timings'])
+
+
+class InvalidImage(ValueError):
+    pass
+
+
+class RecognitionBusy(Exception):
+    # Raised when the job queue is full; the web tier answers 503 right away
+    def __init__(self, msg='Face recognition is busy, please retry shortly.', retry_after=1):
+        super().__init__(msg)
+        self.retry_after = retry_after
+
+
+class RecognitionTimeout(RecognitionBusy):
+    def __init__(self, retry_after=1):
+        super().__init__('Face recognition timed out, please retry.', retry_after)
+
+
+def _init_worker():
+    # Importing face_recognition loads the dlib models; do it once per worker
+    import face_recognition  # noqa: F401
+
+
+def warm_up_worker():
+    # One small detection and encoding so the dlib models and their caches
+    # are loaded before the first real request
+    import face_recognition
+    import numpy as np
+
+    image = np.zeros((96, 96, 3), dtype=np.uint8)
+    face_recognition.face_locations(image)
+    face_recognition.face_encodings(image, [(16, 80, 80, 16)])
+    return os.getpid()
+
+
+def box_iou(a, b):
+    # Intersection over union of two (top, right, bottom, left) boxes
+    top, bottom = max(a[0], b[0]), min(a[2], b[2])
+    left, right = max(a[3], b[3]), min(a[1], b[1])
+    inter = max(0, bottom - top) * max(0, right - left)
+    union = (a[2] - a[0]) * (a[1] - a[3]) + (b[2] - b[0]) * (b[1] - b[3]) - inter
+    return inter / union if union > 0 else 0.0
+
+
+def detect_and_encode(data, max_side=None, max_faces=None, model='hog', upsample=1, skip_boxes=None, skip_iou=0.5):
+    # Runs in a worker process: decode the upload, detect on a downscaled copy,
+    # then encode at full resolution. Encodings are skipped when more than
+    # max_faces faces are found. Faces overlapping one of skip_boxes by at
+    # least skip_iou are not encoded and get None in the encodings list.
+    import face_recognition
+    from app.imaging import StageTimer, decode_image, downscale, scale_boxes
+
+    timer = StageTimer()
+    with timer.stage('decode'):
+        image = decode_image(data)
+    with timer.stage('resize'):
+        small, scale = downscale(image, max_side)
+    with timer.stage('detect'):
+        boxes = face_recognition.face_locations(small, number_of_times_to_upsample=upsample, model=model)
+        locations = scale_boxes(boxes, scale, image.shape)
+    if not locations or (max_faces is not None and len(locations) > max_faces):
+        return FaceResult(locations, [], timer.timings)
+    todo = [box for box in locations
+            if not skip_boxes or max(box_iou(box, skip) for skip in skip_boxes) < skip_iou]
+    encodings = []
+    if todo:
+        with timer.stage('encode'):
+            encoded = dict(zip(todo, face_recognition.face_encodings(image, todo)))
+        encodings = [encoded.get(box) for box in locations]
+    elif locations:
+        encodings = [None] * len(locations)
+    return FaceResult(locations, encodings, timer.timings)
+
+
+class RecognitionService:
+    """Runs dlib work on a bounded pool of worker processes.
+
+    The pool, and the bound on running plus queued jobs, belong to one
+    server process. RECOGNITION_WORKERS = 0 runs jobs inline on the calling
+    thread, e.g. for tests and debugging.
+    """
+
+    def __init__(self, app=None):
+        self.workers = 0
+        self.queue_size = 0
+        self.timeout = None
+        self.retry_after = 1
+        self.detection = {}
+        self._pending = 0
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.workers = app.config['RECOGNITION_WORKERS']
+        if multiprocessing.parent_process() is not None:
+            # A spawned child (e.g. a worker re-importing the entry point)
+            # never starts a pool of its own
+            self.workers = 0
+        self.queue_size = app.config['RECOGNITION_QUEUE_SIZE']
+        self.timeout = app.config['RECOGNITION_TIMEOUT']
+        self.retry_after = app.config['RECOGNITION_RETRY_AFTER']
+        self.detection = {
+            'max_side': app.config['DETECTION_MAX_SIDE'],
+            'model': app.config['DETECTION_MODEL'],
+            'upsample': app.config['DETECTION_UPSAMPLE'],
+        }
+        app.extensions['recognition'] = self
+
+    @property
+    def pending(self):
+        # Jobs running or waiting in the pool
+        return self._pending
+
+    @property
+    def capacity(self):
+        # Most jobs a single call can submit (None when running inline)
+        return self.workers + self.queue_size if self.workers else None
+
+    def _get_executor(self):
+        # Pools don't survive a fork, so each server process builds its own
+        with self._lock:
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.workers,
+                    mp_context=multiprocessing.get_context('spawn'),
+                    initializer=_init_worker,
+                )
+                self._pid = os.getpid()
+                atexit.register(self._executor.shutdown, wait=False, cancel_futures=True)
+            return self._executor
+
+    def _reset_executor(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
+        executor.shutdown(wait=False, cancel_futures=True)
+
+    def shutdown(self):
+        # Stops this process's pool; the next job starts a new one
+        with self._lock:
+            executor, self._executor = self._executor, None
+        if executor is not None:
+            executor.shutdown(wait=True, cancel_futures=True)
+
+    def _acquire(self, count):
+        # One slot per running or queued job; the pool's own queue is unbounded
+        with self._lock:
+            if self._pending + count > self.workers + self.queue_size:
+                raise RecognitionBusy(retry_after=self.retry_after)
+            self._pending += count
+
+    def _release(self, count=1):
+        with self._lock:
+            self._pending -= count
+
+    def _run_all(self, fn, calls):
+        if not self.workers:
+            return [fn(*args) for args in calls]
+
+        self._acquire(len(calls))
+        executor = self._get_executor()
+        futures = []
+        try:
+            for args in calls:
+                future = executor.submit(fn, *args)
+                # The slot is freed when the job really ends, not when we stop waiting
+                future.add_done_callback(lambda _: self._release())
+                futures.append(future)
+        except BrokenProcessPool:
+            self._release(len(calls) - len(futures))
+            self._reset_executor(executor)
+            raise RecognitionBusy(retry_after=self.retry_after)
+
+        deadline = time.monotonic() + self.timeout
+        try:
+            return [future.result(timeout=max(deadline - time.monotonic(), 0)) for future in futures]
+        except FutureTimeout:
+            for future in futures:
+                future.cancel()
+            raise RecognitionTimeout(retry_after=self.retry_after)
+        except BrokenProcessPool:
+            self._reset_executor(executor)
+            raise RecognitionBusy(retry_after=self.retry_after)
+
+    def map(self, fn, *iterables):
+        # Runs fn over the argument lists in parallel and returns the results
+        # in order. Either all jobs get a slot or none is submitted.
+        return self._run_all(fn, list(zip(*iterables)))
+
+    def run(self, fn, *args):
+        return self._run_all(fn, [args])[0]
+
+    def warm_up(self):
+        # Starts the pool and submits one warm_up_worker job per worker (or
+        # runs it inline). A process that finishes early may take several,
+        # so some may only load the models on their first real job. Bypasses
+        # the request slots and timeout since spawning workers can take a while.
+        if not self.workers:
+            return [warm_up_worker()]
+        executor = self._get_executor()
+        return [f.result() for f in [executor.submit(warm_up_worker) for _ in range(self.workers)]]
+
+    def encode_images(self, images, max_faces=None, skip_boxes=None, skip_iou=0.5, max_side=None, upsample=None):
+        # One FaceResult per uploaded image buffer, using the app's detection
+        # settings unless max_side/upsample are given for this call
+        max_side = self.detection['max_side'] if max_side is None else max_side
+        upsample = self.detection['upsample'] if upsample is None else upsample
+        calls = [(data, max_side, max_faces, self.detection['model'], upsample, skip_boxes, skip_iou)
+                 for data in images]
+        return self._run_all(detect_and_encode, calls)
+
+
+recognition = RecognitionService()
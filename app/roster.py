@@ -0,0 +1,163 @@
+import csv
+import json
+import multiprocessing
+import os
+import secrets
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from . import db
+from app.gallery import gallery
+from app.models import User
+from app.recognition import _init_worker, detect_and_encode
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+class Person:
+    def __init__(self, name, role='student', password=None):
+        self.name = name
+        self.role = role
+        self.password = password
+        self.images = []
+
+
+def read_roster(source):
+    # Either a directory with one sub-directory of images per person (named
+    # after the person), or a CSV manifest with name,image[,password,role]
+    # rows; image paths are relative to the manifest.
+    people = {}
+    if os.path.isdir(source):
+        for name in sorted(os.listdir(source)):
+            folder = os.path.join(source, name)
+            if not os.path.isdir(folder):
+                continue
+            person = people[name] = Person(name)
+            person.images = [os.path.join(folder, f) for f in sorted(os.listdir(folder))
+                             if f.lower().endswith(IMAGE_EXTENSIONS)]
+    else:
+        base = os.path.dirname(os.path.abspath(source))
+        with open(source, newline='') as f:
+            for row in csv.DictReader(f):
+                name = (row.get('name') or '').strip()
+                if not name:
+                    continue
+                person = people.get(name)
+                if person is None:
+                    person = people[name] = Person(name, (row.get('role') or 'student').strip(),
+                                                   row.get('password') or None)
+                image = (row.get('image') or '').strip()
+                if image:
+                    person.images.append(os.path.join(base, image))
+    return list(people.values())
+
+
+def encode_person(paths, max_side, model, upsample):
+    # Runs in a worker process. Keeps every image with exactly one face and
+    # reports the others; returns (encodings, problems).
+    encodings, problems = [], []
+    for path in paths:
+        try:
+            with open(path, 'rb') as f:
+                result = detect_and_encode(f.read(), max_side, 1, model, upsample)
+        except (OSError, ValueError) as e:
+            problems.append(f'{os.path.basename(path)}: {e}')
+            continue
+        if not result.locations:
+            problems.append(f'{os.path.basename(path)}: no face detected')
+        elif len(result.locations) > 1:
+            problems.append(f'{os.path.basename(path)}: multiple faces detected')
+        else:
+            encodings.append(result.encodings[0])
+    return encodings, problems
+
+
+def read_report(path):
+    # Names already imported by a previous run
+    done = set()
+    if os.path.exists(path):
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get('status') == 'ok':
+                    done.add(entry['name'])
+    return done
+
+
+def import_roster(people, report_path, config, workers=None, batch_size=100, default_password=None, echo=print):
+    # Encodes people on a process pool and writes users in batched
+    # transactions. Every outcome is appended to the report once it is
+    # durable, so an interrupted run can simply be started again.
+    done = read_report(report_path)
+    existing = {name for name, in db.session.query(User.name)}
+    todo = []
+    for person in people:
+        if person.name in done or person.name in existing:
+            continue
+        todo.append(person)
+    echo(f'{len(todo)} people to import, {len(people) - len(todo)} already done.')
+
+    counts = {'ok': 0, 'failed': 0}
+    pending_users, pending_entries = [], []
+
+    def flush(report):
+        if pending_users:
+            db.session.add_all(pending_users)
+            db.session.commit()
+        for entry in pending_entries:
+            report.write(json.dumps(entry) + '\n')
+        report.flush()
+        pending_users.clear()
+        pending_entries.clear()
+        echo(f"Imported {counts['ok']}, failed {counts['failed']}, remaining {len(todo) - counts['ok'] - counts['failed']}.")
+
+    def collect(person, encodings, problems):
+        entry = {'name': person.name, 'images': len(person.images), 'problems': problems}
+        if not encodings:
+            entry['status'] = 'failed'
+            counts['failed'] += 1
+        else:
+            entry.update(status='ok', templates=len(encodings))
+            counts['ok'] += 1
+            user = User(name=person.name, role=person.role)
+            user.set_password(person.password or default_password or secrets.token_urlsafe(12))
+            user.set_face_encodings(encodings)
+            pending_users.append(user)
+        pending_entries.append(entry)
+
+    detection = (config['DETECTION_MAX_SIDE'], config['DETECTION_MODEL'], config['DETECTION_UPSAMPLE'])
+    workers = workers or os.cpu_count() or 1
+    with open(report_path, 'a') as report, ProcessPoolExecutor(
+        max_workers=workers,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_worker,
+    ) as executor:
+        # Keep a bounded window of jobs in flight instead of queueing everyone
+        queue = iter(todo)
+        running = {}
+        while True:
+            for person in queue:
+                if not person.images:
+                    collect(person, [], ['no images'])
+                    continue
+                running[executor.submit(encode_person, person.images, *detection)] = person
+                if len(running) >= workers * 4:
+                    break
+            if not running:
+                break
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                person = running.pop(future)
+                try:
+                    collect(person, *future.result())
+                except Exception as e:
+                    collect(person, [], [str(e)])
+            if len(pending_entries) >= batch_size:
+                flush(report)
+        flush(report)
+    if counts['ok']:
+        # Running servers only learn about users through the gallery
+        gallery.invalidate()
+    return counts
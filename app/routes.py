@@ -1,18 +1,66 @@
 import os
-import numpy as np
-import cv2
-import face_recognition
-from flask import Blueprint, render_template, request, jsonify, current_app, redirect, url_for, abort, flash
+from flask import Blueprint, Response, render_template, request, jsonify, current_app, redirect, url_for, abort, flash
 from . import db
 from datetime import datetime, timedelta
 from app import login
 from app.forms import SemesterForm, CourseForm, EnrollmentForm
 from app.models import User, Semester, Course, Enrollment, AttendanceLog
+from app.attendance import course_summaries, course_trend, forget_user, is_marked, session_key, student_rates
+from app.writebuffer import attendance_writer, WriteTimeout
+from app.gallery import gallery, template_distance
+from app.recognition import recognition, RecognitionBusy, InvalidImage
+from app.kiosk import kiosks
+from app.warmup import warmup
+from app.throttle import limiter, recent_marks, RateLimited
+from app import metrics
 from flask_login import login_user, logout_user, login_required, current_user
+from sqlalchemy import select
+from sqlalchemy.orm import joinedload
+from app.pagination import filter_logs, keyset_page, parse_date
 from werkzeug.utils import secure_filename
 
 bp = Blueprint('main', __name__)
 
+@bp.errorhandler(RecognitionBusy)
+def recognition_busy(e):
+    headers = {'Retry-After': str(e.retry_after)}
+    if request.endpoint == 'main.register':
+        return render_template('register.html', error=str(e)), 503, headers
+    return jsonify({'success': False, 'msg': str(e)}), 503, headers
+
+@bp.errorhandler(WriteTimeout)
+def write_timeout(e):
+    return jsonify({'success': False, 'msg': str(e)}), 503, {'Retry-After': '1'}
+
+@bp.errorhandler(RateLimited)
+def rate_limited(e):
+    metrics.observe_outcome('rate_limited')
+    headers = {'Retry-After': str(e.retry_after)}
+    if request.endpoint == 'main.register':
+        return render_template('register.html', error=str(e)), 429, headers
+    return jsonify({'success': False, 'msg': str(e)}), 429, headers
+
+@bp.errorhandler(InvalidImage)
+def invalid_image(e):
+    if request.endpoint == 'main.register':
+        return render_template('register.html', error=str(e)), 400
+    return jsonify({'success': False, 'msg': str(e)}), 400
+
+def log_timings(results):
+    metrics.observe_images(results)
+    for result in results:
+        current_app.logger.debug('%s recognition timings (ms): %s', request.endpoint,
+                                 {k: round(v, 1) for k, v in result.timings.items()})
+
+@bp.route('/metrics')
+def metrics_endpoint():
+    return Response(metrics.registry.render(), mimetype='text/plain; version=0.0.4')
+
+@bp.route('/healthz/ready')
+def ready():
+    status = warmup.status()
+    return jsonify(status), 200 if status['ready'] else 503
+
 @bp.route('/')
 @bp.route('/index')
 def index():
@@ -23,9 +71,22 @@ def index():
 def attendance_page():
     if current_user.role != 'student':
         abort(403)
-    return render_template('attendance.html')
+    courses = Course.query.join(Enrollment).filter(Enrollment.student_id == current_user.id).all()
+    return render_template('attendance.html', courses=courses)
+
+def resolve_course(course_id):
+    # Explicit course from the client, otherwise the only course the student
+    # is enrolled in (there is no timetable to pick the running session from)
+    if course_id is not None:
+        return db.session.get(Course, course_id)
+    if current_user.role == 'student':
+        courses = Course.query.join(Enrollment).filter(Enrollment.student_id == current_user.id).limit(2).all()
+        if len(courses) == 1:
+            return courses[0]
+    return None
 
 @bp.route('/register', methods=['GET', 'POST'])
+@limiter.limit
 def register():
     if request.method == 'POST':
         name = request.form['name']
@@ -42,61 +103,266 @@ def register():
         if len(face_images) < 5:
             return render_template('register.html', error="Please capture all face images.")
 
+        # All five images are encoded in parallel on the recognition workers
+        results = recognition.encode_images([f.read() for f in face_images], max_faces=1)
+        log_timings(results)
         encodings = []
-        for idx, img_file in enumerate(face_images):
-            img = face_recognition.load_image_file(img_file)
-            face_locations = face_recognition.face_locations(img)
-            print(f"Image {idx+1}: Detected {len(face_locations)} faces")
+        for idx, (face_locations, face_encodings, _) in enumerate(results):
+            current_app.logger.debug('Image %d: detected %d faces', idx + 1, len(face_locations))
             if len(face_locations) < 1:
+                metrics.observe_outcome('no_face')
                 return render_template('register.html', error=f"Image {idx+1}: No face detected. Please try again.")
             elif len(face_locations) > 1:
+                metrics.observe_outcome('multiple_faces')
                 return render_template('register.html', error=f"Image {idx+1}: Multiple faces detected. Only one person should be visible.")
-            encoding = face_recognition.face_encodings(img, face_locations)[0]
-            encodings.append(encoding)
+            encodings.append(face_encodings[0])
 
-        # Store encodings as a list (using PickleType in your model)
+        # Store encodings as a packed float32 blob (see FaceEmbedding)
         user = User(name=name, role=role)
         user.set_password(password)
-        user.face_encoding = encodings  # PickleType can store a list
+        user.set_face_encodings(encodings)
         db.session.add(user)
-        db.session.commit()
+        with metrics.commit_timer('request'):
+            db.session.commit()
+        gallery.update_user(user.id, encodings)
+        metrics.observe_outcome('accepted')
         flash('Registration successful! Please log in.')
         return redirect(url_for('main.login'))
 
     return render_template('register.html')
 
 
+def already_marked(user_id, course_id, key):
+    # Memory first; the indexed lookup covers marks made by other processes
+    if (user_id, course_id, key) in recent_marks:
+        return True
+    if is_marked(user_id, course_id, key):
+        recent_marks.add((user_id, course_id, key))
+        return True
+    return False
+
 @bp.route('/api/mark_attendance', methods=['POST'])
 @login_required
+@limiter.limit
 def mark_attendance():
     image_file = request.files.get('image')
     if not image_file:
         return jsonify({'success': False, 'msg': 'No image provided.'}), 400
-
-    img = face_recognition.load_image_file(image_file)
-    face_locations = face_recognition.face_locations(img)
+    course = resolve_course(request.form.get('course_id', type=int))
+    if course is None:
+        return jsonify({'success': False, 'msg': 'Please select a course.'}), 400
+    if current_user.role == 'teacher' and course.teacher_id != current_user.id:
+        abort(403)
+    # A student's repeat attempts in this window never reach the recognizer
+    key = session_key()
+    if current_user.role == 'student' and already_marked(current_user.id, course.id, key):
+        metrics.observe_outcome('duplicate')
+        return jsonify({'success': True, 'duplicate': True,
+                        'msg': f'Attendance already marked for {current_user.name} in {course.code}.'})
+
+    result = recognition.encode_images([image_file.read()], max_faces=1)[0]
+    log_timings([result])
+    face_locations, face_encodings = result.locations, result.encodings
     if len(face_locations) != 1:
+        metrics.observe_outcome('no_face' if not face_locations else 'multiple_faces')
         return jsonify({'success': False, 'msg': 'No face or multiple faces detected.'}), 400
-    encoding = face_recognition.face_encodings(img, face_locations)[0]
+    encoding = face_encodings[0]
+
+    # Only the students enrolled in this course are candidates
+    with metrics.stage('match'):
+        match = gallery.match(encoding, course_id=course.id)
+    if not match or match.distance > current_app.config['FACE_MATCH_TOLERANCE']:
+        metrics.observe_outcome('rejected', match)
+        return jsonify({'success': False, 'msg': 'Face not recognized.'}), 401
+    # Students can only mark their own attendance
+    if current_user.role == 'student' and match.user_id != current_user.id:
+        metrics.observe_outcome('wrong_user', match)
+        return jsonify({'success': False, 'msg': 'Face does not match the signed-in student.'}), 401
+    user = db.session.get(User, match.user_id)
+    if not user:
+        return jsonify({'success': False, 'msg': 'Face not recognized.'}), 401
+
+    metrics.observe_outcome('accepted', match)
+    inserted = attendance_writer.write([(user.id, course.id)])
+    recent_marks.add((user.id, course.id, key))
+    if not inserted:
+        return jsonify({'success': True, 'duplicate': True,
+                        'msg': f'Attendance already marked for {user.name} in {course.code}.'})
+    return jsonify({'success': True, 'msg': f'Attendance marked for {user.name} in {course.code}.'})
+
+def teacher_courses():
+    # Courses the current teacher may take attendance for (admins: all)
+    if current_user.role == 'admin':
+        return Course.query.order_by(Course.code).all()
+    return current_user.taught_courses.order_by(Course.code).all()
+
+@bp.route('/group_attendance')
+@login_required
+def group_attendance_page():
+    if current_user.role not in ['teacher', 'admin']:
+        abort(403)
+    return render_template('group_attendance.html', courses=teacher_courses())
 
-    # Compare with all users
-    users = User.query.all()
-    for user in users:
-        if user.face_encoding is not None:
-            stored_encoding = np.array(user.face_encoding)
-            match = face_recognition.compare_faces([stored_encoding], encoding, tolerance=0.6)[0]
-            if match:
-                # Mark attendance logic here
-                return jsonify({'success': True, 'msg': f'Attendance marked for {user.name}.'})
-    return jsonify({'success': False, 'msg': 'Face not recognized.'}), 401
+@bp.route('/api/group_attendance', methods=['POST'])
+@login_required
+@limiter.limit
+def group_attendance():
+    if current_user.role not in ['teacher', 'admin']:
+        abort(403)
+    course = db.session.get(Course, request.form.get('course_id', type=int) or 0)
+    if course is None:
+        return jsonify({'success': False, 'msg': 'Please select a course.'}), 400
+    if current_user.role == 'teacher' and course.teacher_id != current_user.id:
+        abort(403)
+    images = [f.read() for f in request.files.getlist('images')]
+    if not images:
+        return jsonify({'success': False, 'msg': 'No image provided.'}), 400
+    max_photos = current_app.config['GROUP_MAX_PHOTOS']
+    if recognition.capacity:
+        max_photos = min(max_photos, recognition.capacity)
+    if len(images) > max_photos:
+        return jsonify({'success': False, 'msg': f'Please upload at most {max_photos} photos at a time.'}), 400
+
+    # Detect once per photo and batch-encode every face
+    results = recognition.encode_images(images, max_side=current_app.config['GROUP_DETECTION_MAX_SIDE'],
+                                        upsample=current_app.config['GROUP_DETECTION_UPSAMPLE'])
+    log_timings(results)
+    faces = [(image_idx, box, encoding)
+             for image_idx, result in enumerate(results)
+             for box, encoding in zip(result.locations, result.encodings)]
+
+    # Whole face set against the course gallery in one matrix operation
+    with metrics.stage('match'):
+        assigned = gallery.assign([encoding for _, _, encoding in faces],
+                                  current_app.config['FACE_MATCH_TOLERANCE'], course_id=course.id)
+
+    students = {user.id: user for user in User.query.join(Enrollment, Enrollment.student_id == User.id)
+                .filter(Enrollment.course_id == course.id)}
+    recognized, unrecognized = [], []
+    for face_idx, (image_idx, box, _) in enumerate(faces):
+        match = assigned.get(face_idx)
+        if match is None or match.user_id not in students:
+            metrics.observe_outcome('rejected', match)
+            unrecognized.append({'image': image_idx, 'box': list(box)})
+            continue
+        metrics.observe_outcome('accepted', match)
+        recognized.append({
+            'image': image_idx,
+            'box': list(box),
+            'user_id': match.user_id,
+            'name': students[match.user_id].name,
+            'distance': round(match.distance, 4),
+        })
+
+    if recognized:
+        attendance_writer.write([(face['user_id'], course.id) for face in recognized])
+
+    present = {face['user_id'] for face in recognized}
+    absent = [{'user_id': user.id, 'name': user.name}
+              for user in sorted(students.values(), key=lambda u: u.name) if user.id not in present]
+    return jsonify({
+        'success': True,
+        'msg': f'Attendance marked for {len(recognized)} of {len(students)} students in {course.code}.',
+        'recognized': recognized,
+        'unrecognized': unrecognized,
+        'absent': absent,
+    })
+
+@bp.route('/kiosk')
+@login_required
+def kiosk_page():
+    if current_user.role not in ['teacher', 'admin']:
+        abort(403)
+    return render_template('kiosk.html', courses=teacher_courses())
+
+@bp.route('/api/kiosk/sessions', methods=['POST'])
+@login_required
+def kiosk_start():
+    if current_user.role not in ['teacher', 'admin']:
+        abort(403)
+    course = db.session.get(Course, request.form.get('course_id', type=int) or 0)
+    if course is None:
+        return jsonify({'success': False, 'msg': 'Please select a course.'}), 400
+    if current_user.role == 'teacher' and course.teacher_id != current_user.id:
+        abort(403)
+    session = kiosks.create(course.id, current_user.id, current_app.config)
+    return jsonify({'success': True, 'token': session.token, 'msg': f'Kiosk started for {course.code}.'})
+
+@bp.route('/api/kiosk/sessions/<token>', methods=['DELETE'])
+@login_required
+def kiosk_stop(token):
+    session = kiosks.get(token, current_app.config)
+    if session is None or session.owner_id != current_user.id:
+        return jsonify({'success': False, 'msg': 'Unknown kiosk session.'}), 404
+    kiosks.close(token)
+    return jsonify({'success': True, 'msg': f'Kiosk stopped, {len(session.logged)} students marked.'})
+
+@bp.route('/api/kiosk/sessions/<token>/frames', methods=['POST'])
+@login_required
+def kiosk_frame(token):
+    session = kiosks.get(token, current_app.config)
+    if session is None or session.owner_id != current_user.id:
+        return jsonify({'success': False, 'msg': 'Unknown kiosk session.'}), 404
+    image_file = request.files.get('image')
+    if not image_file:
+        return jsonify({'success': False, 'msg': 'No image provided.'}), 400
+    data = image_file.read()
+
+    with session.lock:
+        # Faces still covered by a confident track are detected but not re-encoded
+        result = recognition.encode_images([data], skip_boxes=session.skip_boxes(),
+                                           skip_iou=session.min_confidence)[0]
+        log_timings([result])
+        tolerance = current_app.config['FACE_MATCH_TOLERANCE']
+        for track, encoding in session.update(result.locations, result.encodings):
+            with metrics.stage('match'):
+                match = gallery.match(encoding, course_id=session.course_id)
+            accepted = match is not None and match.distance <= tolerance
+            metrics.observe_outcome('accepted' if accepted else 'rejected', match)
+            if accepted:
+                if track.user_id != match.user_id:
+                    track.name = None
+                track.user_id, track.distance = match.user_id, match.distance
+            else:
+                track.user_id = track.name = track.distance = None
+
+        # Each student is logged once per kiosk session
+        new_ids = {t.user_id for t in session.tracks if t.user_id is not None} - session.logged
+        names = {}
+        if new_ids:
+            names = dict(User.query.with_entities(User.id, User.name).filter(User.id.in_(new_ids)))
+            attendance_writer.write([(user_id, session.course_id) for user_id in names])
+            session.logged.update(names)
+        for track in session.tracks:
+            if track.user_id is not None and track.name is None:
+                track.name = names.get(track.user_id) or db.session.get(User, track.user_id).name
+        return jsonify({
+            'success': True,
+            'frame': session.frames,
+            'encoded': sum(e is not None for e in result.encodings),
+            'tracks': session.to_dict(),
+            'marked': list(names.values()),
+            'total_marked': len(session.logged),
+        })
 
 @bp.route('/logs')
 @login_required
 def show_logs():
     if current_user.role not in ['teacher', 'admin']:
         abort(403)
-    logs = AttendanceLog.query.order_by(AttendanceLog.timestamp.desc()).all()
-    return render_template('logs.html', logs=logs)
+    filters = {
+        'course_id': request.args.get('course_id', type=int),
+        'start': parse_date(request.args.get('start')),
+        'end': parse_date(request.args.get('end')),
+    }
+    student = request.args.get('student', '').strip()
+    if student:
+        filters['user_ids'] = select(User.id).where(User.name == student)
+    query = filter_logs(AttendanceLog.query, **filters).options(
+        joinedload(AttendanceLog.user), joinedload(AttendanceLog.course))
+    logs, next_cursor = keyset_page(query, request.args.get('cursor'), current_app.config['LOGS_PER_PAGE'])
+    courses = Course.query.order_by(Course.code).all()
+    return render_template('logs.html', logs=logs, next_cursor=next_cursor, courses=courses)
 
 @login.user_loader
 def load_user(user_id):
@@ -141,8 +407,16 @@ def logout():
 @bp.route('/mylogs')
 @login_required
 def my_logs():
-    logs = AttendanceLog.query.filter_by(user_id=current_user.id).all()
-    return render_template('mylogs.html', logs=logs)
+    filters = {
+        'course_id': request.args.get('course_id', type=int),
+        'start': parse_date(request.args.get('start')),
+        'end': parse_date(request.args.get('end')),
+    }
+    query = filter_logs(AttendanceLog.query.filter_by(user_id=current_user.id), **filters).options(
+        joinedload(AttendanceLog.course))
+    logs, next_cursor = keyset_page(query, request.args.get('cursor'), current_app.config['LOGS_PER_PAGE'])
+    courses = Course.query.join(Enrollment).filter(Enrollment.student_id == current_user.id).all()
+    return render_template('mylogs.html', logs=logs, next_cursor=next_cursor, courses=courses)
 
 @bp.route('/user/<int:user_id>/edit', methods=['GET', 'POST'])
 @login_required
@@ -165,6 +439,7 @@ def edit_user(user_id):
         if password:
             user.set_password(password)
         db.session.commit()
+        gallery.update_user(user.id, user.face_encodings)
         flash('User updated successfully.', 'success')
         return redirect(url_for('main.show_users'))
 
@@ -179,9 +454,12 @@ def delete_user(user_id):
     if user.id == current_user.id:
         flash("You cannot delete yourself.", "danger")
         return redirect(url_for('main.show_users'))
-    AttendanceLog.query.filter_by(user_id=user.id).delete()
+    courses = forget_user(user.id)
     db.session.delete(user)
     db.session.commit()
+    gallery.remove_user(user_id)
+    for course_id in courses:
+        gallery.invalidate_course(course_id)
     flash("User deleted.", "success")
     return redirect(url_for('main.show_users'))
 
@@ -245,6 +523,7 @@ def create_enrollment():
             )
             db.session.add(enrollment)
             db.session.commit()
+            gallery.invalidate_course(enrollment.course_id)
             flash('Student enrolled!')
         return redirect(url_for('main.index'))
     return render_template('create_enrollment.html', form=form)
@@ -252,12 +531,30 @@ def create_enrollment():
 @bp.route('/admin/dashboard')
 @login_required
 def admin_dashboard():
-    return render_template('admin_dashboard.html')
+    if current_user.role != 'admin':
+        abort(403)
+    semesters = Semester.query.order_by(Semester.name).all()
+    semester = db.session.get(Semester, request.args.get('semester_id', type=int) or 0)
+    if semester is None and semesters:
+        semester = semesters[-1]
+    courses = semester.courses.order_by(Course.code).all() if semester else []
+    return render_template('admin_dashboard.html', semesters=semesters, semester=semester,
+                           summaries=course_summaries(courses))
 
 @bp.route('/teacher/dashboard')
 @login_required
 def teacher_dashboard():
-    return render_template('teacher_dashboard.html')
+    if current_user.role not in ['teacher', 'admin']:
+        abort(403)
+    summaries = course_summaries(teacher_courses())
+    course = db.session.get(Course, request.args.get('course_id', type=int) or 0)
+    if course is None and summaries:
+        course = summaries[0]['course']
+    if course is not None and current_user.role == 'teacher' and course.teacher_id != current_user.id:
+        abort(403)
+    sessions, students = student_rates(course.id) if course else (0, [])
+    return render_template('teacher_dashboard.html', summaries=summaries, course=course, sessions=sessions,
+                           students=students, trend=course_trend(course.id) if course else [])
 
 @bp.route('/student/dashboard')
 @login_required
@@ -265,24 +562,33 @@ def student_dashboard():
     return render_template('student_dashboard.html')
 
 @bp.route('/api/login_face', methods=['POST'])
+@limiter.limit
 def login_face():
     name = request.form.get('name')
     image_file = request.files.get('image')
     user = User.query.filter_by(name=name).first()
-    if not user or not user.face_encoding:
+    if not user or user.face_embedding is None:
         return jsonify({'success': False, 'msg': 'User not found or no face encoding.'}), 404
+    if not image_file:
+        return jsonify({'success': False, 'msg': 'No image provided.'}), 400
+    # Attempts against one account are limited however many IPs they come from
+    limiter.hit([('login', user.id)])
 
-    img = face_recognition.load_image_file(image_file)
-    face_locations = face_recognition.face_locations(img)
+    result = recognition.encode_images([image_file.read()], max_faces=1)[0]
+    log_timings([result])
+    face_locations, face_encodings = result.locations, result.encodings
     if len(face_locations) != 1:
+        metrics.observe_outcome('no_face' if not face_locations else 'multiple_faces')
         return jsonify({'success': False, 'msg': 'No face or multiple faces detected.'}), 400
-    encoding = face_recognition.face_encodings(img, face_locations)[0]
+    encoding = face_encodings[0]
 
-    # Compare against all stored encodings (face_encoding is a list)
-    import numpy as np
-    matches = face_recognition.compare_faces([np.array(e) for e in user.face_encoding], encoding, tolerance=0.6)
-    if any(matches):
+    # Compare against all stored encodings of this user
+    with metrics.stage('match'):
+        distance = template_distance(user.face_encodings, encoding)
+    if distance <= current_app.config['FACE_MATCH_TOLERANCE']:
+        metrics.observe_outcome('accepted')
         login_user(user)
         return jsonify({'success': True, 'msg': 'Login successful!', 'role': user.role})
     else:
+        metrics.observe_outcome('rejected')
         return jsonify({'success': False, 'msg': 'Face does not match.'}), 401
\ No newline at end of file
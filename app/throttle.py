@@ -0,0 +1,116 @@
+import math
+import threading
+import time
+from functools import wraps
+
+from flask import request
+from flask_login import current_user
+
+
+class RateLimited(Exception):
+    def __init__(self, retry_after=1):
+        super().__init__('Too many requests, please slow down.')
+        self.retry_after = retry_after
+
+
+class TokenBucket:
+    __slots__ = ('tokens', 'updated')
+
+    def __init__(self, burst, now):
+        self.tokens = burst
+        self.updated = now
+
+
+class RateLimiter:
+    """Per-user and per-IP token buckets for the recognition endpoints.
+
+    A request costs one token from its client IP's bucket and, when signed
+    in, one from the user's; a face login also costs one from the target
+    account's 'login' bucket (see hit()). Buckets refill at *_RATE tokens per second up
+    to *_BURST. A rate of 0 turns that limit off. Buckets are per process,
+    which is enough to keep floods away from the recognition workers. The
+    client IP is request.remote_addr, so behind a proxy set PROXY_FIX_X_FOR.
+    """
+
+    def __init__(self, app=None):
+        self.limits = {}
+        self.max_keys = 10000
+        self._buckets = {}
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.limits = {
+            'user': (app.config['RATE_LIMIT_USER_RATE'], app.config['RATE_LIMIT_USER_BURST']),
+            'ip': (app.config['RATE_LIMIT_IP_RATE'], app.config['RATE_LIMIT_IP_BURST']),
+            'login': (app.config['RATE_LIMIT_LOGIN_RATE'], app.config['RATE_LIMIT_LOGIN_BURST']),
+        }
+        app.extensions['rate_limiter'] = self
+
+    def _prune(self, now):
+        # Drop buckets that have refilled completely; they hold no state
+        for key, bucket in list(self._buckets.items()):
+            rate, burst = self.limits[key[0]]
+            if bucket.tokens + (now - bucket.updated) * rate >= burst:
+                del self._buckets[key]
+
+    def hit(self, keys):
+        # Takes a token from every bucket or, if one is empty, from none
+        now = time.monotonic()
+        with self._lock:
+            buckets = []
+            for key in keys:
+                rate, burst = self.limits[key[0]]
+                if not rate:
+                    continue
+                bucket = self._buckets.get(key)
+                if bucket is None:
+                    if len(self._buckets) >= self.max_keys:
+                        self._prune(now)
+                    bucket = self._buckets[key] = TokenBucket(burst, now)
+                bucket.tokens = min(burst, bucket.tokens + (now - bucket.updated) * rate)
+                bucket.updated = now
+                if bucket.tokens < 1:
+                    raise RateLimited(retry_after=max(1, math.ceil((1 - bucket.tokens) / rate)))
+                buckets.append(bucket)
+            for bucket in buckets:
+                bucket.tokens -= 1
+
+    def limit(self, view):
+        # Only submissions cost a token, not loading the page
+        @wraps(view)
+        def wrapped(*args, **kwargs):
+            if request.method != 'GET':
+                keys = [('ip', request.remote_addr)]
+                if current_user.is_authenticated:
+                    keys.append(('user', current_user.id))
+                self.hit(keys)
+            return view(*args, **kwargs)
+        return wrapped
+
+
+class RecentMarks:
+    # In-memory record of (user, course, session key) triples already logged,
+    # so repeat attempts are answered without touching the image. The
+    # unique session index on AttendanceLog stays the source of truth.
+    def __init__(self, max_keys=100000):
+        self.max_keys = max_keys
+        self._keys = set()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        return key in self._keys
+
+    def add(self, key):
+        with self._lock:
+            if len(self._keys) >= self.max_keys:
+                # Keys of past windows never match again
+                self._keys = {k for k in self._keys if k[2] >= key[2]}
+                if len(self._keys) >= self.max_keys:
+                    self._keys.clear()
+            self._keys.add(key)
+
+
+limiter = RateLimiter()
+recent_marks = RecentMarks()
@@ -0,0 +1,94 @@
+import multiprocessing
+import os
+import threading
+import time
+
+import click
+from flask.helpers import get_debug_flag
+
+
+def serves_requests():
+    # False for processes that load the app but never serve it: spawned
+    # children (recognition workers re-importing the entry point), flask CLI
+    # commands other than `run`, and the file-watching reloader parent
+    if multiprocessing.parent_process() is not None:
+        return False
+    ctx = click.get_current_context(silent=True)
+    if ctx is None:
+        return True
+    if ctx.info_name != 'run':
+        return False
+    reload = ctx.params.get('reload')
+    if reload is None:
+        reload = get_debug_flag()
+    return not reload or os.environ.get('WERKZEUG_RUN_MAIN') == 'true'
+
+
+class WarmUp:
+    """Loads the recognition models and the face gallery in the background.
+
+    create_app returns straight away; /healthz/ready answers 503 until every
+    step has finished so a load balancer only routes to warm processes. With
+    WARMUP disabled everything is loaded lazily by the first request and the
+    process reports ready immediately.
+    """
+
+    def __init__(self, app=None):
+        self.enabled = False
+        self.ready = False
+        self.error = None
+        self.timings = {}
+        self._app = None
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.enabled = app.config['WARMUP'] and serves_requests()
+        self._app = app
+        app.extensions['warmup'] = self
+        if self.enabled:
+            self.start()
+
+    def start(self):
+        # Threads don't survive a fork, so a forked server process warms up
+        # again; a failed warm-up is retried on the next readiness check
+        with self._lock:
+            if self._pid == os.getpid() and (self.ready or self._thread.is_alive()):
+                return
+            self.ready, self.error, self.timings = False, None, {}
+            self._thread = threading.Thread(target=self._run, name='warm-up', daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def _step(self, name, fn):
+        start = time.perf_counter()
+        fn()
+        self.timings[name] = round((time.perf_counter() - start) * 1000.0, 1)
+
+    def _run(self):
+        from app.gallery import gallery
+        from app.recognition import recognition
+
+        app = self._app
+        try:
+            self._step('recognition', recognition.warm_up)
+            with app.app_context():
+                self._step('gallery', gallery.snapshot)
+        except Exception as e:
+            app.logger.exception('Warm-up failed')
+            self.error = str(e)
+            return
+        self.ready = True
+        app.logger.info('Warm-up finished (ms): %s', self.timings)
+
+    def status(self):
+        if not self.enabled:
+            return {'ready': True}
+        self.start()
+        return {'ready': self.ready, 'steps': dict(self.timings), 'error': self.error}
+
+
+warmup = WarmUp()
@@ -0,0 +1,124 @@
+import os
+import queue
+import threading
+import time
+
+from . import db
+from app.attendance import record_attendance
+from app.metrics import commit_timer
+
+
+class WriteTimeout(Exception):
+    pass
+
+
+class _Job:
+    def __init__(self, entries):
+        self.entries = entries
+        self.inserted = []
+        self.done = threading.Event()
+        self.error = None
+
+
+class AttendanceWriter:
+    """Group commit for AttendanceLog writes.
+
+    Requests hand their rows to a single writer thread, which gathers
+    everything that arrives within ATTENDANCE_BATCH_WINDOW_MS into one
+    transaction. write() only returns once that transaction has committed,
+    with the entries that were new in the current attendance window.
+    A window of 0 writes inline on the request's own session.
+    """
+
+    def __init__(self, app=None):
+        self.window = 0.0
+        self.max_batch = 200
+        self.timeout = 10
+        self._app = None
+        self._queue = queue.Queue()
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        if app is not None:
+            self.init_app(app)
+
+    def init_app(self, app):
+        self.window = app.config['ATTENDANCE_BATCH_WINDOW_MS'] / 1000.0
+        self.max_batch = app.config['ATTENDANCE_BATCH_MAX']
+        self.timeout = app.config['ATTENDANCE_WRITE_TIMEOUT']
+        self._app = app
+        app.extensions['attendance_writer'] = self
+
+    @property
+    def pending(self):
+        return self._queue.qsize()
+
+    def write(self, entries):
+        entries = list(entries)
+        if not entries:
+            return []
+        if not self.window:
+            inserted = record_attendance(entries)
+            with commit_timer('request'):
+                db.session.commit()
+            return inserted
+        job = _Job(entries)
+        self._ensure_thread()
+        self._queue.put(job)
+        if not job.done.wait(self.timeout):
+            raise WriteTimeout('Attendance could not be saved in time, please retry.')
+        if job.error is not None:
+            raise job.error
+        return job.inserted
+
+    def _ensure_thread(self):
+        # Threads don't survive a fork, so each server process starts its own
+        with self._lock:
+            if self._thread is None or self._pid != os.getpid():
+                self._queue = queue.Queue()
+                self._thread = threading.Thread(target=self._run, name='attendance-writer', daemon=True)
+                self._pid = os.getpid()
+                self._thread.start()
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.window
+        while len(batch) < self.max_batch:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _commit(self, jobs):
+        inserted = set(record_attendance([entry for job in jobs for entry in job.entries]))
+        with commit_timer('writer'):
+            db.session.commit()
+        # Two requests for the same student in one batch: the first one wins
+        for job in jobs:
+            job.inserted = [entry for entry in job.entries if entry in inserted]
+            inserted.difference_update(job.inserted)
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            with self._app.app_context():
+                try:
+                    self._commit(batch)
+                except Exception:
+                    db.session.rollback()
+                    # Retry one by one so a bad row only fails its own request
+                    for job in batch:
+                        try:
+                            self._commit([job])
+                        except Exception as e:
+                            db.session.rollback()
+                            job.error = e
+            for job in batch:
+                job.done.set()
+
+
+attendance_writer = AttendanceWriter()
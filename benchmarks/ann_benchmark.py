@@ -0,0 +1,97 @@
+"""Recall and latency of the IVF gallery backend against exact search.
+
+Runs on synthetic embeddings, no database or dlib needed:
+
+    python benchmarks/ann_benchmark.py --sizes 10000 50000 250000
+"""
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from app.embeddings import EMBEDDING_DIM  # noqa: E402
+from app.gallery import FaceGallery  # noqa: E402
+
+
+def synthetic_gallery(num_users, samples, rng, spread=0.05):
+    # dlib-like layout: identities far apart, their samples ~0.3-0.4 from
+    # each other, so the 0.6 match tolerance separates them
+    centers = rng.normal(0.0, 0.09, (num_users, EMBEDDING_DIM)).astype(np.float32)
+    matrix = np.repeat(centers, samples, axis=0)
+    matrix += rng.normal(0.0, spread / np.sqrt(2), matrix.shape).astype(np.float32)
+    user_ids = np.repeat(np.arange(1, num_users + 1, dtype=np.int64), samples)
+    return centers, matrix, user_ids
+
+
+def timed_matches(gallery, queries):
+    latencies, users = [], []
+    for query in queries:
+        start = time.perf_counter()
+        match = gallery.match(query)
+        latencies.append((time.perf_counter() - start) * 1000.0)
+        users.append(match.user_id)
+    return np.array(latencies), np.array(users)
+
+
+def run(size, args, rng):
+    num_users = max(1, size // args.samples)
+    centers, matrix, user_ids = synthetic_gallery(num_users, args.samples, rng)
+    truth = rng.integers(0, num_users, args.queries)
+    queries = centers[truth] + rng.normal(0.0, 0.05 / np.sqrt(2), (args.queries, EMBEDDING_DIM)).astype(np.float32)
+
+    exact = FaceGallery(backend='exact')
+    exact.replace(matrix, user_ids)
+    start = time.perf_counter()
+    ivf = FaceGallery(backend='ivf', nlist=args.nlist, nprobe=args.nprobe, min_rows=0)
+    ivf.replace(matrix, user_ids)
+    build_ms = (time.perf_counter() - start) * 1000.0
+
+    exact_ms, exact_users = timed_matches(exact, queries)
+    ivf_ms, ivf_users = timed_matches(ivf, queries)
+    return {
+        'templates': int(len(user_ids)),
+        'users': num_users,
+        'nlist': ivf._ivf.nlist,
+        'nprobe': args.nprobe,
+        'ivf_build_ms': round(build_ms, 1),
+        'recall_at_1': float(np.mean(ivf_users == exact_users)),
+        'exact_p50_ms': round(float(np.percentile(exact_ms, 50)), 3),
+        'exact_p99_ms': round(float(np.percentile(exact_ms, 99)), 3),
+        'ivf_p50_ms': round(float(np.percentile(ivf_ms, 50)), 3),
+        'ivf_p99_ms': round(float(np.percentile(ivf_ms, 99)), 3),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10000, 50000, 250000],
+                        help='Gallery sizes in templates.')
+    parser.add_argument('--samples', type=int, default=5, help='Templates per user.')
+    parser.add_argument('--queries', type=int, default=500)
+    parser.add_argument('--nlist', type=int, default=None, help='IVF partitions (default: 4 * sqrt(size)).')
+    parser.add_argument('--nprobe', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', dest='json_path', help='Also write the results to this file.')
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(args.seed)
+    results = []
+    header = f"{'templates':>10} {'nlist':>6} {'recall@1':>9} {'exact p50':>10} {'exact p99':>10} {'ivf p50':>8} {'ivf p99':>8}"
+    print(header)
+    for size in args.sizes:
+        r = run(size, args, rng)
+        results.append(r)
+        print(f"{r['templates']:>10} {r['nlist']:>6} {r['recall_at_1']:>9.4f} {r['exact_p50_ms']:>10.3f} "
+              f"{r['exact_p99_ms']:>10.3f} {r['ivf_p50_ms']:>8.3f} {r['ivf_p99_ms']:>8.3f}")
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == '__main__':
+    main()
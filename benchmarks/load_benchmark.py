@@ -0,0 +1,401 @@
+"""Throughput, latency and memory of the recognition endpoints under load.
+
+Every gallery size runs in a fresh process against a throwaway SQLite
+database seeded with synthetic users (random 128-d templates stored through
+the User model). Requests go through the Flask test client from a pool of
+concurrent clients:
+
+    python benchmarks/load_benchmark.py --users 100 1000 10000 --json run.json
+    python benchmarks/load_benchmark.py --baseline run.json --max-regression 20
+
+Sample images come from --images (one face per file) or are rendered
+locally. dlib rarely finds a face in the rendered ones, so with inline
+recognition (--workers 0, the default) an image without a detected face
+is answered as one face with the probe student's encoding: decode and
+detection are still timed, and matching, attendance writes and face login
+run against the real gallery. With --workers the rendered images only
+exercise decode and detection; the status counts in the report show which
+path the requests took.
+"""
+import argparse
+import io
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import shutil
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from datetime import datetime, timedelta
+
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from ann_benchmark import synthetic_gallery  # noqa: E402
+
+ENDPOINTS = ('register', 'mark_attendance', 'mark_attendance_repeat', 'login_face', 'show_logs')
+PASSWORD = 'benchmark'
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png')
+
+
+def render_faces(count, rng):
+    # Cartoon faces drawn with OpenCV; enough to exercise decode, resize and
+    # detection without shipping photos
+    import cv2
+
+    images = []
+    for _ in range(count):
+        image = np.full((480, 640, 3), rng.integers(120, 220, 3), dtype=np.uint8)
+        image += rng.integers(0, 12, image.shape, dtype=np.uint8)
+        cx, cy = 320 + int(rng.integers(-40, 40)), 240 + int(rng.integers(-20, 20))
+        skin = tuple(int(c) for c in rng.integers([90, 120, 170], [140, 170, 230]))
+        cv2.ellipse(image, (cx, cy), (95, 125), 0, 0, 360, skin, -1)
+        for dx in (-38, 38):
+            cv2.ellipse(image, (cx + dx, cy - 30), (18, 9), 0, 0, 360, (255, 255, 255), -1)
+            cv2.circle(image, (cx + dx, cy - 30), 6, (40, 30, 20), -1)
+            cv2.line(image, (cx + dx - 22, cy - 55), (cx + dx + 22, cy - 58), (40, 30, 20), 5)
+        cv2.line(image, (cx, cy - 20), (cx - 8, cy + 25), (70, 80, 120), 3)
+        cv2.ellipse(image, (cx, cy + 60), (35, 14), 0, 0, 180, (60, 60, 150), 4)
+        ok, data = cv2.imencode('.jpg', image)
+        images.append(data.tobytes())
+    return images
+
+
+# (top, right, bottom, left) of the face in a rendered image
+RENDERED_FACE = (115, 415, 365, 225)
+
+
+def known_face(detect, encoding):
+    # Wraps detect_and_encode: an image dlib finds no face in is reported as
+    # the rendered face with the given encoding
+    from app.recognition import FaceResult
+
+    def detect_and_encode(data, *args, **kwargs):
+        result = detect(data, *args, **kwargs)
+        if result.locations:
+            return result
+        return FaceResult([RENDERED_FACE], [encoding], result.timings)
+    return detect_and_encode
+
+
+def load_images(path, rng):
+    if not path:
+        return render_faces(8, rng)
+    images = []
+    for name in sorted(os.listdir(path)):
+        if name.lower().endswith(IMAGE_EXTENSIONS):
+            with open(os.path.join(path, name), 'rb') as f:
+                images.append(f.read())
+    if not images:
+        raise SystemExit(f'No images in {path}')
+    return images
+
+
+def reset_peak_rss():
+    # Restarts the high-water mark of this process and the recognition
+    # workers (Linux 4.0+), so the next peak_rss_mb() covers one endpoint.
+    # Returns False where that is not possible.
+    try:
+        for pid in ['self'] + _child_pids():
+            with open(f'/proc/{pid}/clear_refs', 'w') as f:
+                f.write('5')
+    except OSError:
+        return False
+    return True
+
+
+def peak_rss_mb():
+    # High-water mark of this process plus the recognition workers since the
+    # last reset_peak_rss() (or since start; ru_maxrss is KiB on Linux and
+    # bytes on macOS)
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    peak = peak / 1024.0 if sys.platform != 'darwin' else peak / 1024.0 / 1024.0
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('VmHWM:'):
+                    peak = int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    for pid in _child_pids():
+        try:
+            with open(f'/proc/{pid}/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        peak += int(line.split()[1]) / 1024.0
+        except OSError:
+            pass
+    return round(peak, 1)
+
+
+def _child_pids():
+    pids = []
+    try:
+        for task in os.listdir('/proc/self/task'):
+            with open(f'/proc/self/task/{task}/children') as f:
+                pids.extend(f.read().split())
+    except OSError:
+        pass
+    return pids
+
+
+def seed(app, num_users, samples, probe_encodings, logs_per_user, rng):
+    # Teacher, course, num_users synthetic students and the probe student
+    # whose face is in the sample images, all enrolled in the course
+    from sqlalchemy import insert
+    from werkzeug.security import generate_password_hash
+
+    from app import db
+    from app.attendance import session_key
+    from app.models import AttendanceLog, Course, Enrollment, Semester, User
+
+    password_hash = generate_password_hash(PASSWORD)
+    _, matrix, _ = synthetic_gallery(num_users, samples, rng)
+    with app.app_context():
+        teacher = User(name='bench-teacher', role='teacher', password_hash=password_hash)
+        probe = User(name='bench-probe', role='student', password_hash=password_hash)
+        probe.set_face_encodings(probe_encodings)
+        semester = Semester(name='Benchmark')
+        db.session.add_all([teacher, probe, semester])
+        db.session.flush()
+        course = Course(name='Benchmark', code='BENCH', teacher_id=teacher.id, semester_id=semester.id)
+        db.session.add(course)
+        db.session.flush()
+        for start in range(0, num_users, 1000):
+            users = []
+            for i in range(start, min(start + 1000, num_users)):
+                user = User(name=f'bench-{i}', role='student', password_hash=password_hash)
+                user.set_face_encodings(matrix[i * samples:(i + 1) * samples])
+                users.append(user)
+            db.session.add_all(users)
+            db.session.flush()
+            db.session.add_all([Enrollment(student_id=user.id, course_id=course.id) for user in users])
+            db.session.commit()
+        db.session.add(Enrollment(student_id=probe.id, course_id=course.id))
+
+        # History for show_logs, plus the probe's mark in the current window
+        # so every mark_attendance_repeat request is a repeat
+        now = datetime.utcnow()
+        user_ids = rng.integers(probe.id + 1, probe.id + 1 + num_users, num_users * logs_per_user)
+        rows = [{'user_id': int(user_id), 'course_id': course.id, 'timestamp': now - timedelta(minutes=int(m))}
+                for user_id, m in zip(user_ids, rng.integers(60, 60 * 24 * 120, len(user_ids)))]
+        for start in range(0, len(rows), 10000):
+            db.session.execute(insert(AttendanceLog), rows[start:start + 10000])
+        db.session.add(AttendanceLog(user_id=probe.id, course_id=course.id, timestamp=now,
+                                     session_key=session_key(now)))
+        db.session.commit()
+        return course.id
+
+
+def drive(make_client, send, total, concurrency, warmup):
+    # concurrency clients fire `total` requests as fast as the app answers;
+    # the first `warmup` requests of each client are not measured
+    clients = [make_client() for _ in range(concurrency)]
+    for client in clients:
+        for i in range(warmup):
+            send(client, i)
+    counter = iter(range(total))
+    lock = threading.Lock()
+    latencies, statuses = [], {}
+
+    def worker(client):
+        while True:
+            with lock:
+                i = next(counter, None)
+            if i is None:
+                return
+            start = time.perf_counter()
+            status = send(client, i)
+            elapsed = (time.perf_counter() - start) * 1000.0
+            with lock:
+                latencies.append(elapsed)
+                statuses[status] = statuses.get(status, 0) + 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        list(pool.map(worker, clients))
+    wall = time.perf_counter() - start
+    latencies = np.array(latencies)
+    return {
+        'requests': int(len(latencies)),
+        'concurrency': concurrency,
+        'throughput_rps': round(len(latencies) / wall, 2),
+        'p50_ms': round(float(np.percentile(latencies, 50)), 2),
+        'p95_ms': round(float(np.percentile(latencies, 95)), 2),
+        'p99_ms': round(float(np.percentile(latencies, 99)), 2),
+        'status': {str(k): v for k, v in sorted(statuses.items())},
+    }
+
+
+def run_size(num_users, args):
+    # Runs in its own process so memory and caches start from scratch
+    from app import create_app
+    from app import recognition as recognition_module
+    from app.recognition import detect_and_encode, recognition
+
+    rng = np.random.default_rng(args.seed)
+    images = load_images(args.images, rng)
+    tmp = tempfile.mkdtemp(prefix='face-bench-')
+    app = create_app({
+        'SQLALCHEMY_DATABASE_URI': f"sqlite:///{os.path.join(tmp, 'bench.sqlite3')}",
+        'GALLERY_PATH': os.path.join(tmp, 'face_gallery.bin') if os.name == 'posix' else None,
+        'ANN_INDEX_PATH': os.path.join(tmp, 'face_index.npz'),
+        'PROFILE_DIR': os.path.join(tmp, 'profiles'),
+        'GALLERY_BACKEND': args.backend,
+        'RECOGNITION_WORKERS': args.workers,
+        'RECOGNITION_QUEUE_SIZE': max(16, args.concurrency * 5),
+        'RATE_LIMIT_USER_RATE': 0,
+        'RATE_LIMIT_IP_RATE': 0,
+        'RATE_LIMIT_LOGIN_RATE': 0,
+        'WARMUP': False,
+        'WTF_CSRF_ENABLED': False,
+    })
+    # This runs in a spawned process, where the app defaults to inline recognition
+    recognition.workers = args.workers
+
+    # The probe student is enrolled with the templates of the sample images
+    # that have exactly one detectable face, or with a synthetic template
+    # that the rendered images then stand for
+    config = app.config
+    probe = []
+    if args.images:
+        for data in images:
+            result = detect_and_encode(data, config['DETECTION_MAX_SIDE'], 1, config['DETECTION_MODEL'],
+                                       config['DETECTION_UPSAMPLE'])
+            if len(result.locations) == 1:
+                probe.append(result.encodings[0])
+    if not probe:
+        probe = [rng.normal(0.0, 0.09, 128)]
+        if not args.images and not args.workers:
+            recognition_module.detect_and_encode = known_face(detect_and_encode, probe[0])
+    course_id = seed(app, num_users, args.samples, probe, args.logs_per_user, rng)
+
+    from app.gallery import gallery
+    with app.app_context():
+        gallery.snapshot()
+        templates = len(gallery)
+
+    def client_as(name=None):
+        def make():
+            client = app.test_client()
+            if name:
+                client.post('/login', data={'name': name, 'password': PASSWORD})
+            return client
+        return make
+
+    registered = iter(range(10 ** 9))
+    register_lock = threading.Lock()
+
+    def register(client, i):
+        with register_lock:
+            n = next(registered)
+        data = {'name': f'bench-reg-{os.getpid()}-{n}', 'password': PASSWORD, 'role': 'student'}
+        for k in range(5):
+            data[f'face_image_{k}'] = (io.BytesIO(images[(i + k) % len(images)]), f'{k}.jpg')
+        return client.post('/register', data=data).status_code
+
+    def mark(client, i):
+        return client.post('/api/mark_attendance', data={
+            'image': (io.BytesIO(images[i % len(images)]), 'mark.jpg'), 'course_id': course_id}).status_code
+
+    def login_face(client, i):
+        return client.post('/api/login_face', data={
+            'name': 'bench-probe', 'image': (io.BytesIO(images[i % len(images)]), 'login.jpg')}).status_code
+
+    def show_logs(client, i):
+        return client.get('/logs').status_code
+
+    plans = {
+        'register': (client_as(), register),
+        'mark_attendance': (client_as('bench-teacher'), mark),
+        'mark_attendance_repeat': (client_as('bench-probe'), mark),
+        'login_face': (client_as(), login_face),
+        'show_logs': (client_as('bench-teacher'), show_logs),
+    }
+    results = []
+    for endpoint in args.endpoints:
+        make_client, send = plans[endpoint]
+        if not reset_peak_rss() and endpoint != args.endpoints[0]:
+            print('note: cannot reset the RSS high-water mark here; '
+                  'peak_rss_mb includes earlier endpoints', file=sys.stderr)
+        r = drive(make_client, send, args.requests, args.concurrency, args.warmup)
+        r.update(endpoint=endpoint, users=num_users, templates=templates, peak_rss_mb=peak_rss_mb())
+        results.append(r)
+    recognition.shutdown()
+    shutil.rmtree(tmp, ignore_errors=True)
+    return results
+
+
+def compare(results, baseline, max_regression):
+    # Prints the change against a saved run; returns the rows whose p95
+    # latency regressed by more than max_regression percent
+    previous = {(r['users'], r['endpoint']): r for r in baseline['results']}
+    regressions = []
+    print(f"\n{'users':>7} {'endpoint':<24} {'rps':>8} {'p50':>8} {'p95':>8}   (change vs baseline)")
+    for r in results:
+        old = previous.get((r['users'], r['endpoint']))
+        if old is None:
+            continue
+        change = {k: (r[k] - old[k]) / old[k] * 100.0 if old[k] else 0.0
+                  for k in ('throughput_rps', 'p50_ms', 'p95_ms')}
+        print(f"{r['users']:>7} {r['endpoint']:<24} {change['throughput_rps']:>+7.1f}% "
+              f"{change['p50_ms']:>+7.1f}% {change['p95_ms']:>+7.1f}%")
+        if max_regression is not None and change['p95_ms'] > max_regression:
+            regressions.append(r)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--users', type=int, nargs='+', default=[100, 1000, 10000],
+                        help='Gallery sizes in synthetic users.')
+    parser.add_argument('--samples', type=int, default=5, help='Templates per synthetic user.')
+    parser.add_argument('--endpoints', nargs='+', choices=ENDPOINTS, default=list(ENDPOINTS))
+    parser.add_argument('--requests', type=int, default=200, help='Measured requests per endpoint.')
+    parser.add_argument('--concurrency', type=int, default=4, help='Concurrent clients.')
+    parser.add_argument('--warmup', type=int, default=2, help='Unmeasured requests per client.')
+    parser.add_argument('--workers', type=int, default=0, help='RECOGNITION_WORKERS (0: inline).')
+    parser.add_argument('--backend', choices=['exact', 'ivf'], default='exact', help='GALLERY_BACKEND.')
+    parser.add_argument('--images', help='Directory of sample face images (default: rendered).')
+    parser.add_argument('--logs-per-user', type=int, default=5, help='Seeded attendance history.')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--json', dest='json_path', help='Write the results to this file.')
+    parser.add_argument('--baseline', help='Results file of an earlier run to compare against.')
+    parser.add_argument('--max-regression', type=float, default=None,
+                        help='Exit with status 1 if any p95 latency grew by more than this percent.')
+    args = parser.parse_args()
+
+    results = []
+    print(f"{'users':>7} {'endpoint':<24} {'rps':>8} {'p50 ms':>8} {'p95 ms':>8} {'p99 ms':>8} {'rss MB':>8}  status")
+    for num_users in args.users:
+        with ProcessPoolExecutor(1, mp_context=multiprocessing.get_context('spawn')) as executor:
+            for r in executor.submit(run_size, num_users, args).result():
+                results.append(r)
+                print(f"{r['users']:>7} {r['endpoint']:<24} {r['throughput_rps']:>8.1f} {r['p50_ms']:>8.2f} "
+                      f"{r['p95_ms']:>8.2f} {r['p99_ms']:>8.2f} {r['peak_rss_mb']:>8.1f}  {r['status']}")
+
+    run = {
+        'created': datetime.utcnow().isoformat(timespec='seconds'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'args': {k: v for k, v in vars(args).items() if k not in ('json_path', 'baseline')},
+        'results': results,
+    }
+    if args.json_path:
+        with open(args.json_path, 'w') as f:
+            json.dump(run, f, indent=2)
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.max_regression)
+        if regressions:
+            print(f'\n{len(regressions)} endpoint(s) regressed by more than {args.max_regression}% at p95.')
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()